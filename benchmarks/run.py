@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""Measures the overhead of metagit itself on synthetic configurations.
+
+For every size (number of repositories) a temporary directory with fake
+local repositories is created and the hot paths are timed: add_set,
+_select, status_line, the repo lister cache and the dispatch of foreach
+with a no-op scm. No network access is needed. The results are written
+as JSON, e.g. for comparing two revisions:
+
+  python3 benchmarks/run.py --sizes 100,1000 --output before.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import optparse
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from gmp.main import *
+
+# Number of sets the repositories are distributed over
+SETS = 10
+
+
+class NoopSCM(SCM):
+    """Every scm command is a call of true(1)"""
+    name = "noop"
+    binary = "true"
+
+
+class FakeLister(RepoLister):
+    """Lists the synthetic repositories, without asking a remote site"""
+    def __init__(self, urls, **kwargs):
+        RepoLister.__init__(self, **kwargs)
+        self.fake_urls = urls
+
+    def get_list(self):
+        self.clone_urls = self.fake_urls
+
+
+def make_repos(directory, size):
+    """Creates size fake repositories below directory: every second one
+    exists (with a .git directory), the others are not cloned"""
+    repos = []
+    for i in range(size):
+        local = os.path.join(directory, "s%d" % (i % SETS), "r%05d" % i)
+        if i % 2 == 0:
+            os.makedirs(os.path.join(local, ".git"))
+            with open(os.path.join(local, ".git", "HEAD"), "w") as fd:
+                fd.write("ref: refs/heads/master\n")
+        repos.append(Repository("ssh://git.example.org/srv/r%05d.git" % i, local,
+                                scm = NoopSCM()))
+    return repos
+
+
+def new_manager(repos):
+    manager = RepoManager()
+    # RepoManager.sets is shared by all instances
+    manager.sets = {}
+    for i in range(SETS):
+        manager.add_set("s%d" % i, repos[i::SETS])
+    return manager
+
+
+def measure(function, repeat, setup = None):
+    """Returns the wall times of repeat calls of function"""
+    times = []
+    for i in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def benchmarks(directory, size, skip):
+    """Yields (name, function, setup) for all benchmarks of one size"""
+    repos = make_repos(directory, size)
+    cold = lambda: StateCache.invalidate()
+
+    def add_set():
+        for repo in repos:
+            repo.set = []
+        new_manager(repos)
+    yield "add_set", add_set, None
+
+    manager = new_manager(repos)
+    yield "select_all", lambda: manager._select("all"), cold
+    yield "select_state", lambda: manager._select("+"), cold
+    yield "select_set", lambda: manager._select("set:s3"), cold
+    yield "select_regexp", lambda: manager._select("r0.*7$"), cold
+    yield "select_path", lambda: manager._select("path:^%s/s5/" % directory), cold
+
+    yield "status_line", lambda: [repo.status_line() for repo in repos], None
+
+    lister = FakeLister([(repo.clone_url, repo.local_url) for repo in repos],
+                        cache = os.path.join(directory, "cache"), into = "/",
+                        scm = NoopSCM())
+    RepoLister.listers.remove(lister)
+    listed = lister.create_repos()
+    yield "cache_save", lambda: lister.save_cache(listed), None
+    yield "cache_load", lister.load_cache, None
+
+    if not "foreach" in skip:
+        def foreach():
+            with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+                manager.cmd_foreach(["all", "status"])
+        yield "foreach_noop", foreach, cold
+
+
+def main():
+    parser = optparse.OptionParser(usage = "usage: %prog [options]")
+    parser.add_option("--sizes", default = "100,1000,10000",
+                      help = "comma separated numbers of repositories (default: %default)")
+    parser.add_option("--repeat", type = "int", default = 5,
+                      help = "runs of every benchmark, the fastest one counts (default: %default)")
+    parser.add_option("--skip", default = "",
+                      help = "comma separated benchmarks to skip (e.g. foreach)")
+    parser.add_option("-j", "--jobs", type = "int", default = os.cpu_count() or 1,
+                      help = "parallel jobs for foreach (default: %default)")
+    parser.add_option("-o", "--output", default = None,
+                      help = "write the JSON results to OUTPUT (default: stdout)")
+    options, args = parser.parse_args()
+
+    # foreach runs in parallel mode, its output is discarded
+    Options.parse(["--parallel", "--jobs", str(options.jobs)], RepoManager())
+
+    results = []
+    for size in [int(x) for x in options.sizes.split(",")]:
+        directory = tempfile.mkdtemp(prefix = "metagit-bench-")
+        try:
+            for name, function, setup in benchmarks(directory, size, options.skip.split(",")):
+                times = measure(function, options.repeat, setup)
+                results.append({"benchmark": name, "repos": size,
+                                "best": min(times), "mean": sum(times) / len(times),
+                                "runs": times})
+                sys.stderr.write("%-14s %6d repos %10.4fs\n" % (name, size, min(times)))
+        finally:
+            shutil.rmtree(directory, ignore_errors = True)
+
+    report = {"python": platform.python_version(),
+              "platform": platform.platform(),
+              "created": time.time(),
+              "results": results}
+    if options.output:
+        with open(options.output, "w") as fd:
+            json.dump(report, fd, indent = 2)
+    else:
+        json.dump(report, sys.stdout, indent = 2)
+        sys.stdout.write("\n")
+
+if __name__ == "__main__":
+    main()
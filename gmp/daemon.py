@@ -0,0 +1,390 @@
+import os
+import sys
+import json
+import socket
+
+# This module is imported by bin/metagit before everything else, to ask
+# a running daemon. The client part must stay light, the daemon imports
+# the rest of metagit in its functions
+
+class TerminalRequired(Exception):
+    """A command, which runs in the daemon, wants to read from the
+    terminal (e.g. cd, if several repositories match). The client runs
+    the command itself then"""
+
+
+class NoTerminal:
+    """stdin of the daemon"""
+    def readline(self, *args):
+        raise TerminalRequired()
+    read = readline
+
+    def isatty(self):
+        return False
+
+
+class Inotify:
+    """Watches directories for entries being created, deleted or moved
+    with inotify(7), which is called through ctypes. Without inotify
+    (or if the watches are used up) watch() returns False and the
+    caller has to look for changes itself"""
+
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+
+    mask = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE \
+        | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+    def __init__(self):
+        self.fd = -1
+        self.watches = {}
+        self.directories = {}
+        try:
+            import ctypes, ctypes.util
+            self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+            self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            pass
+
+    def available(self):
+        return self.fd >= 0
+
+    def watch(self, directory):
+        """Returns True, if directory is watched (now)"""
+        if directory in self.directories:
+            return True
+        if self.fd < 0:
+            return False
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.mask)
+        if wd < 0:
+            # Missing directory or no watches left (fs.inotify.max_user_watches)
+            return False
+        self.watches[wd] = directory
+        self.directories[directory] = wd
+        return True
+
+    def read(self):
+        """Returns the events since the last call as a list of
+        (directory, name) tuples. name is None, if the directory isn't
+        watched anymore (e.g. it was deleted). On an overflow of the
+        event queue None is returned"""
+        import struct
+        events = []
+        overflow = False
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+                name = data[offset + 16:offset + 16 + length].rstrip(b"\0")
+                offset += 16 + length
+                if mask & self.IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                directory = self.watches.get(wd)
+                if directory is None:
+                    continue
+                if mask & self.IN_IGNORED:
+                    del self.watches[wd]
+                    del self.directories[directory]
+                    events.append((directory, None))
+                elif name:
+                    events.append((directory, os.fsdecode(name)))
+        if overflow:
+            return None
+        return events
+
+
+class Daemon:
+    """The daemon (see metagit daemon) keeps the sets, the listed
+    repositories and the states of the local repositories in memory and
+    answers list, cd and status --fast for bin/metagit over a unix
+    socket, without loading the configuration. The directories of the
+    repositories are watched with inotify, states of repositories
+    which can't be watched are determined on every request.
+
+    The daemon restarts itself, as soon as the configuration file or a
+    lister cache changes, or a cache expires. Requests are answered one
+    after another"""
+
+    # Commands answered by the daemon, status only with --fast
+    commands = ["list", "cd", "status"]
+    # Seconds the client waits for an answer
+    timeout = 60
+
+    def socket_path(create = False):
+        """$METAGIT_SOCKET, or metagit-<uid>.sock in $XDG_RUNTIME_DIR. Without
+        a runtime directory the socket is kept in the private (0700)
+        directory /tmp/metagit-<uid>, which is created, if create is set"""
+        path = os.getenv("METAGIT_SOCKET")
+        if path:
+            return os.path.expanduser(path)
+        runtime = os.getenv("XDG_RUNTIME_DIR")
+        if runtime:
+            return os.path.join(runtime, "metagit-%d.sock" % os.getuid())
+        directory = "/tmp/metagit-%d" % os.getuid()
+        if create:
+            try:
+                os.mkdir(directory, 0o700)
+            except FileExistsError:
+                pass
+            stat = os.lstat(directory)
+            if stat.st_uid != os.getuid() or stat.st_mode & 0o7777 != 0o700:
+                raise OSError("%s is not a private directory" % directory)
+        return os.path.join(directory, "metagit.sock")
+    socket_path = staticmethod(socket_path)
+
+    def ours(path):
+        """Is path a socket of the current user?"""
+        import stat
+        try:
+            info = os.lstat(path)
+        except OSError:
+            return False
+        return stat.S_ISSOCK(info.st_mode) and info.st_uid == os.getuid()
+    ours = staticmethod(ours)
+
+    def peer_uid(connection):
+        """The uid of the process at the other end of a unix socket"""
+        import struct
+        credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                            struct.calcsize("3i"))
+        return struct.unpack("3i", credentials)[1]
+    peer_uid = staticmethod(peer_uid)
+
+    def request(argv, conffile):
+        """Lets the daemon run the command line argv. Returns the exit
+        code or None, if there is no daemon or it can't answer. Only a
+        daemon of the current user is asked, its answer is printed"""
+        path = Daemon.socket_path()
+        if not Daemon.ours(path):
+            return None
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.settimeout(Daemon.timeout)
+            client.connect(path)
+            if Daemon.peer_uid(client) != os.getuid():
+                return None
+            client.sendall(json.dumps({"argv": argv, "cwd": os.getcwd(),
+                                       "config": os.path.abspath(conffile)}).encode())
+            client.shutdown(socket.SHUT_WR)
+            reply = json.loads(Daemon.__receive(client))
+        except (OSError, ValueError):
+            # Not running (anymore) or restarting
+            return None
+        finally:
+            client.close()
+        if reply.get("fallback"):
+            return None
+        sys.stdout.write(reply["stdout"])
+        sys.stderr.write(reply["stderr"])
+        return reply["exit"]
+    request = staticmethod(request)
+
+    def __receive(connection):
+        chunks = []
+        while True:
+            chunk = connection.recv(65536)
+            if not chunk:
+                return b"".join(chunks).decode()
+            chunks.append(chunk)
+    __receive = staticmethod(__receive)
+
+    def __init__(self, manager, conffile, path = None):
+        self.manager = manager
+        self.conffile = os.path.abspath(conffile)
+        self.path = path
+        self.inotify = Inotify()
+        # Repositories by the directories their states depend on
+        self.depends = {}
+        self.unwatched = []
+
+    def serve(self):
+        """Lists all repositories and answers requests until the daemon
+        is terminated"""
+        import select
+        import signal
+
+        if not self.path:
+            try:
+                self.path = Daemon.socket_path(create = True)
+            except OSError as e:
+                self.manager.die(str(e))
+        if self.__running():
+            self.manager.die("The daemon is already running: " + self.path)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        repos = [repo for s, repo in self.manager._repos()]
+        self.files, self.expires = self.manager._config_files(self.conffile)
+        for repo in repos:
+            for directory in [os.path.dirname(repo.local_url) or ".", repo.local_url]:
+                self.depends.setdefault(directory, []).append(repo)
+            if not self.__watch(repo):
+                self.unwatched.append(repo)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            server.bind(self.path)
+        finally:
+            os.umask(umask)
+        server.listen(16)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        print("metagit daemon: %d repositories (%d watched), listening on %s"
+              % (len(repos), len(repos) - len(self.unwatched), self.path))
+        sys.stdout.flush()
+        sys.stdin = NoTerminal()
+
+        restart = False
+        try:
+            while not restart:
+                ready, _, _ = select.select([server] + ([self.inotify.fd] if self.inotify.available() else []),
+                                            [], [])
+                if self.inotify.fd in ready:
+                    self.__changed()
+                if server in ready:
+                    connection, _ = server.accept()
+                    with connection:
+                        # The socket is private, but better safe than sorry
+                        if Daemon.peer_uid(connection) == os.getuid():
+                            restart = self.__handle(connection)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            os.unlink(self.path)
+        if restart:
+            print("metagit daemon: the configuration changed, restarting")
+            sys.stdout.flush()
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def __running(self):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(self.path)
+            return True
+        except OSError:
+            return False
+        finally:
+            client.close()
+
+    def __watch(self, repo):
+        """Watches the directories the state of repo depends on. Returns
+        False, if a change could go unnoticed"""
+        if not self.inotify.watch(os.path.dirname(repo.local_url) or "."):
+            return False
+        return self.inotify.watch(repo.local_url) or not os.path.lexists(repo.local_url)
+
+    def __changed(self):
+        """Forgets the states of the repositories, whose directories changed"""
+        from gmp.scm import StateCache
+        events = self.inotify.read()
+        if events is None:
+            # Events were lost, every state could have changed
+            StateCache.invalidate()
+            return
+        for directory, name in events:
+            if name is None:
+                # The directory is gone, its repositories aren't watched anymore
+                self.unwatched.extend(self.depends.get(directory, []))
+                for repo in self.depends.get(directory, []):
+                    StateCache.invalidate(repo.local_url)
+                continue
+            StateCache.invalidate(directory)
+            path = os.path.join(directory, name)
+            StateCache.invalidate(path)
+            if path in self.depends:
+                # A repository was created
+                self.inotify.watch(path)
+
+    def __poll(self):
+        """Retries to watch the unwatched repositories and forgets the
+        states of those, which were not watched until now"""
+        from gmp.scm import StateCache
+        for repo in self.unwatched:
+            StateCache.invalidate(repo.local_url)
+        self.unwatched = [repo for repo in self.unwatched if not self.__watch(repo)]
+
+    def __handle(self, connection):
+        """Answers one request. Returns True, if the daemon has to restart"""
+        connection.settimeout(Daemon.timeout)
+        try:
+            request = json.loads(Daemon.__receive(connection))
+        except (OSError, ValueError):
+            return False
+        restart = self.manager._outdated(self.files, self.expires)
+        if restart or request.get("config") != self.conffile:
+            reply = {"fallback": True}
+        else:
+            if self.inotify.available():
+                self.__changed()
+            self.__poll()
+            reply = self.__run(request["argv"], request["cwd"])
+        try:
+            connection.sendall(json.dumps(reply).encode())
+        except OSError:
+            pass
+        return restart
+
+    def __answers(self, args):
+        """Can the daemon run the parsed command line?"""
+        from gmp.options import Options
+        if not args or Options.opt("timings") or Options.opt("profile") \
+           or Options.opt("screen") or Options.opt("tmux"):
+            return False
+        command = self.manager.short_commands.get(args[0])
+        short = [x for x in self.manager.commands if x.startswith(args[0])]
+        if len(short) == 1:
+            command = short[0]
+        if command == "status":
+            return Options.opt("fast") or "--fast" in args
+        return command in self.commands
+
+    def __run(self, argv, cwd):
+        import io
+        import contextlib
+        from gmp.options import Options
+        from gmp.scheduler import Scheduler
+        from gmp.timings import Timings
+
+        stdout, stderr = io.StringIO(), io.StringIO()
+        code = 0
+        options = Options.instance
+        try:
+            with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                os.chdir(cwd)
+                Options.instance = Options(argv, self.manager)
+                if not self.__answers(Options.instance.args):
+                    return {"fallback": True}
+                self.manager.dispatch(Options.instance.args)
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                code = e.code
+            elif e.code is not None:
+                stderr.write("%s\n" % e.code)
+                code = 1
+        except TerminalRequired:
+            return {"fallback": True}
+        except Exception:
+            # The client can still run the command itself
+            import traceback
+            traceback.print_exc()
+            return {"fallback": True}
+        finally:
+            Options.instance = options
+            if Scheduler.instance:
+                Scheduler.instance.loop.close()
+                Scheduler.instance = None
+            del Timings.records[:]
+        return {"exit": code, "stdout": stdout.getvalue(), "stderr": stderr.getvalue()}
@@ -0,0 +1,130 @@
+import os
+import sys
+import time
+
+class Frecency:
+    """Remembers how often and how recently every repository was
+    changed to with metagit cd ($METAGIT_FRECENCY, default:
+    ~/.metagit-frecency). One line per repository: count, time of the
+    last use and the local url"""
+
+    # Once the counts add up to more than this, all of them are aged
+    # (multiplied by 0.9) and rarely used repositories are forgotten
+    max_count = 1000
+
+    def __init__(self, path = None):
+        if not path:
+            path = os.getenv("METAGIT_FRECENCY") or "~/.metagit-frecency"
+        self.path = os.path.expanduser(path)
+        self.entries = None
+
+    def __load(self):
+        if self.entries is not None:
+            return self.entries
+        self.entries = {}
+        try:
+            with open(self.path) as fd:
+                for line in fd:
+                    fields = line.rstrip("\n").split("\t", 2)
+                    if len(fields) == 3:
+                        try:
+                            self.entries[fields[2]] = (float(fields[0]), float(fields[1]))
+                        except ValueError:
+                            continue
+        except OSError:
+            pass
+        return self.entries
+
+    def score(self, local_url, now = None):
+        """Count of uses, weighted by the time since the last one"""
+        count, last = self.__load().get(local_url, (0, 0))
+        if not count:
+            return 0
+        age = (now or time.time()) - last
+        if age < 3600:
+            return count * 4
+        if age < 86400:
+            return count * 2
+        if age < 7 * 86400:
+            return count / 2
+        return count / 4
+
+    def record(self, local_url):
+        """Counts a use of local_url and writes the store"""
+        import tempfile
+        entries = self.__load()
+        count, last = entries.get(local_url, (0, 0))
+        entries[local_url] = (count + 1, time.time())
+        if sum([x[0] for x in entries.values()]) > self.max_count:
+            for url, (count, last) in list(entries.items()):
+                if count * 0.9 < 1:
+                    del entries[url]
+                else:
+                    entries[url] = (count * 0.9, last)
+        try:
+            fd, tmp = tempfile.mkstemp(dir = os.path.dirname(self.path) or ".", prefix = ".metagit-frecency-")
+            with os.fdopen(fd, "w") as store:
+                for url, (count, last) in entries.items():
+                    store.write("%g\t%.0f\t%s\n" % (count, last, url))
+            os.replace(tmp, self.path)
+        except OSError as e:
+            sys.stderr.write("WARNING: Could not write %s (%s)\n" % (self.path, e))
+
+
+def match_class(query, local_url):
+    """How well the query matches the local url, 0 if it doesn't.
+    Matches of the repository name are better than of the path;
+    exact ones are better than prefixes, substrings and subsequences"""
+    query = query.lower()
+    path = local_url.lower().rstrip("/")
+    name = os.path.basename(path)
+    if name == query:
+        return 6
+    if name.startswith(query):
+        return 5
+    if query in name:
+        return 4
+    if query in path:
+        return 3
+    if is_subsequence(query, name):
+        return 2
+    if is_subsequence(query, path):
+        return 1
+    return 0
+
+def is_subsequence(query, text):
+    """Are the characters of query found in text in the same order?"""
+    position = 0
+    for char in query:
+        position = text.find(char, position) + 1
+        if position == 0:
+            return False
+    return True
+
+def rank(query, local_urls, frecency, exists = os.path.isdir):
+    """Returns the local urls matching the query, the best first: by
+    match class (see match_class), then by frecency, then the shorter
+    path. Without a query all urls match equally. The second value is
+    the number of urls in the best match class, which are equally good
+    candidates. Matching urls, which don't exist, are left out, as are
+    duplicates (a repository can be in several sets)"""
+    now = time.time()
+    ranked = []
+    seen = set()
+    for local_url in local_urls:
+        if local_url in seen:
+            continue
+        seen.add(local_url)
+        cls = match_class(query, local_url) if query is not None else 1
+        if cls and exists(local_url):
+            ranked.append((-cls, -frecency.score(local_url, now), len(local_url), local_url))
+    ranked.sort()
+    if not ranked:
+        return [], 0
+
+    best = [x for x in ranked if x[0] == ranked[0][0]]
+    candidates = len(best)
+    if candidates > 1 and -best[0][1] > 0 and best[0][1] <= 2 * best[1][1]:
+        # Used at least twice as much as the next one
+        candidates = 1
+    return [x[3] for x in ranked], candidates
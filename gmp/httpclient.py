@@ -0,0 +1,108 @@
+import threading
+import http.client
+import urllib.parse
+import urllib.request
+import urllib.error
+
+class HTTPError(Exception):
+    def __init__(self, url, status):
+        Exception.__init__(self, "HTTP %d: %s" % (status, url))
+        self.url = url
+        self.status = status
+
+
+class HTTPClient:
+    """A minimal HTTP client, which keeps the connections to every host
+    alive and shares them between threads (e.g. for fetching the pages
+    of an API listing concurrently)"""
+    instance = None
+    # api.github.com rejects requests without a User-Agent
+    user_agent = "metagit"
+    # Redirects are followed (e.g. for renamed users), as urllib does
+    max_redirects = 5
+    redirects = [301, 302, 303, 307, 308]
+    # Headers, which aren't sent to another host after a redirect
+    credentials = ["authorization", "private-token"]
+
+    def __init__(self, timeout = 30):
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get():
+        if not HTTPClient.instance:
+            HTTPClient.instance = HTTPClient()
+        return HTTPClient.instance
+    get = staticmethod(get)
+
+    def __connect(self, scheme, netloc):
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout = self.timeout)
+        return http.client.HTTPConnection(netloc, timeout = self.timeout)
+
+    def __acquire(self, scheme, netloc):
+        with self.lock:
+            idle = self.idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+        return self.__connect(scheme, netloc), False
+
+    def __release(self, scheme, netloc, connection):
+        with self.lock:
+            self.idle.setdefault((scheme, netloc), []).append(connection)
+
+    def request(self, url, headers = {}):
+        """GETs url and returns (status, headers, body). Redirects are
+        followed"""
+        headers = dict(headers)
+        if not "user-agent" in [x.lower() for x in headers]:
+            headers["User-Agent"] = self.user_agent
+        for redirect in range(self.max_redirects + 1):
+            status, response, body = self.__request(url, headers)
+            if not status in self.redirects or not response.get("Location"):
+                return status, response, body
+            location = urllib.parse.urljoin(url, response["Location"])
+            if urllib.parse.urlsplit(location).netloc != urllib.parse.urlsplit(url).netloc:
+                headers = dict([(k, v) for k, v in headers.items()
+                                if not k.lower() in self.credentials])
+            url = location
+        raise HTTPError(url, status)
+
+    def __request(self, url, headers):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme in urllib.request.getproxies():
+            return self.__urllib(url, headers)
+
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        connection, reused = self.__acquire(parts.scheme, parts.netloc)
+        try:
+            connection.request("GET", path, headers = headers)
+            response = connection.getresponse()
+            body = response.read()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            if not reused:
+                raise
+            # The server closed the idle connection, try a fresh one
+            connection = self.__connect(parts.scheme, parts.netloc)
+            connection.request("GET", path, headers = headers)
+            response = connection.getresponse()
+            body = response.read()
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.__release(parts.scheme, parts.netloc, connection)
+        return response.status, response.headers, body
+
+    def __urllib(self, url, headers):
+        """urllib knows how to talk to proxies"""
+        request = urllib.request.Request(url, headers = headers)
+        try:
+            response = urllib.request.urlopen(request, timeout = self.timeout)
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, e.read()
+        return response.status, response.headers, response.read()
@@ -0,0 +1,161 @@
+import os
+import sys
+
+# bin/metagit answers metagit complete with this module alone, before
+# the configuration is loaded. Don't import the rest of metagit here
+
+class RepoIndex:
+    """An index of all repositories on disk ($METAGIT_INDEX, default:
+    ~/.metagit-index), which answers completions (see metagit complete)
+    without loading the configuration or listing repo listers.
+
+    The index is a text file with one entry per line, sorted bytewise:
+
+      c <command>
+      s <selector word>
+      r <local url>\\t<state>\\t<scm>\\t<sets>\\t<clone url>
+
+    Selector words are the names, local paths, urls, sets and scms of
+    the repositories. A lookup bisects the memory mapped file for the
+    first line with the prefix, so it doesn't get slower with the
+    number of repositories. The first line records the configuration
+    file and the modification times of it and the lister caches; the
+    index is outdated, as soon as one of them changes"""
+
+    version = 1
+    # Kinds of entries
+    COMMAND = "c"
+    SELECTOR = "s"
+    REPOSITORY = "r"
+
+    def __init__(self, path = None):
+        if not path:
+            path = os.getenv("METAGIT_INDEX") or "~/.metagit-index"
+        self.path = os.path.expanduser(path)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def fresh(self, conffile):
+        """Was the index built from conffile and is it up to date?"""
+        try:
+            with open(self.path, "rb") as fd:
+                header = fd.readline().decode(errors = "surrogateescape").rstrip("\n").split("\t")
+        except OSError:
+            return False
+        if header[:3] != ["#", str(self.version), os.path.abspath(conffile)]:
+            return False
+        files = header[3:]
+        for name, mtime in zip(files[0::2], files[1::2]):
+            try:
+                if repr(os.stat(name).st_mtime) != mtime:
+                    return False
+            except OSError:
+                if mtime != "-":
+                    return False
+        return True
+
+    def write(self, conffile, files, commands, repos):
+        """Rewrites the index. files maps the configuration file and the
+        lister caches to their modification times (None if missing)"""
+        import tempfile
+        entries = set()
+        for command in commands:
+            entries.add("%s %s" % (self.COMMAND, command))
+        for repo in repos:
+            local = repo.short_local_url()
+            words = ["all", os.path.basename(repo.local_url), local, repo.clone_url,
+                     "path:" + local, "url:" + repo.clone_url, "scm:" + repo.scm.name]
+            words += ["set:" + s for s in repo.set]
+            for word in words:
+                entries.add("%s %s" % (self.SELECTOR, word))
+            entries.add("%s %s\t%s\t%s\t%s\t%s" % (self.REPOSITORY, repo.local_url, repo.get_state(),
+                                                 repo.scm.name, ":".join(repo.set), repo.clone_url))
+        lines = sorted([x.encode(errors = "surrogateescape") for x in entries if not "\n" in x])
+
+        header = ["#", str(self.version), os.path.abspath(conffile)]
+        for name, mtime in files.items():
+            header += [name, "-" if mtime is None else repr(mtime)]
+        fd, tmp = tempfile.mkstemp(dir = os.path.dirname(self.path) or ".", prefix = ".metagit-index-")
+        try:
+            with os.fdopen(fd, "wb") as index:
+                index.write("\t".join(header).encode(errors = "surrogateescape") + b"\n")
+                index.write(b"\n".join(lines) + b"\n")
+            os.replace(tmp, self.path)
+        except OSError as e:
+            sys.stderr.write("WARNING: Could not write index: %s (%s)\n" % (self.path, e))
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def lookup(self, kind, prefix = ""):
+        """Returns the entries of kind, which start with prefix (without
+        the kind), in sorted order"""
+        import mmap
+        key = ("%s %s" % (kind, prefix)).encode(errors = "surrogateescape")
+        try:
+            with open(self.path, "rb") as fd:
+                if os.fstat(fd.fileno()).st_size == 0:
+                    return []
+                with mmap.mmap(fd.fileno(), 0, access = mmap.ACCESS_READ) as data:
+                    return self.__lookup(data, key)
+        except OSError:
+            return []
+
+    def __lookup(self, data, key):
+        # Bisect for the first line >= key; lo and hi are line beginnings
+        lo, hi = 0, len(data)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = data.rfind(b"\n", 0, mid) + 1
+            end = data.find(b"\n", start)
+            if end < 0:
+                end = len(data)
+            if data[start:end] < key:
+                lo = end + 1
+            else:
+                hi = start
+
+        result = []
+        skip = len(key) - len(key.split(b" ", 1)[1])
+        while lo < len(data):
+            end = data.find(b"\n", lo)
+            if end < 0:
+                end = len(data)
+            line = data[lo:end]
+            if not line.startswith(key):
+                break
+            result.append(line[skip:].decode(errors = "surrogateescape"))
+            lo = end + 1
+        return result
+
+    def complete(self, args, out = sys.stdout):
+        """Prints the completions for the arguments of metagit complete:
+        [command] <prefix>"""
+        kind = self.SELECTOR
+        if len(args) == 2:
+            kind = self.COMMAND
+        prefix = args[-1] if args else ""
+        for entry in self.lookup(kind, prefix):
+            out.write(entry + "\n")
+
+    def repositories(self):
+        """Returns all indexed repositories as dicts with the keys
+        local_url, state, scm, sets and clone_url. Repositories with the
+        same local url (from several sets) are returned once, with the
+        sets of all of them"""
+        repos = []
+        by_local_url = {}
+        for entry in self.lookup(self.REPOSITORY):
+            fields = entry.split("\t")
+            if len(fields) != 5:
+                continue
+            sets = fields[3].split(":") if fields[3] else []
+            if fields[0] in by_local_url:
+                repo = by_local_url[fields[0]]
+                repo["sets"] += [x for x in sets if not x in repo["sets"]]
+                continue
+            repo = {"local_url": fields[0], "state": fields[1], "scm": fields[2],
+                    "sets": sets, "clone_url": fields[4]}
+            by_local_url[fields[0]] = repo
+            repos.append(repo)
+        return repos
@@ -1,22 +1,38 @@
 import os, sys
-import urllib.request, urllib.error, urllib.parse, urllib.request, urllib.parse, urllib.error
+import atexit
 import re
+import shlex
 import subprocess
-import json
-from xml.dom.minidom import parse as xml_parse
+import time
+import tempfile
+import threading
 
 from gmp.policy import *
 from gmp.repository import *
 from gmp.tools import *
+from gmp.timings import *
+
+# The network and parser modules are only imported, when a lister
+# actually lists (or reads its cache). This keeps the startup fast
 #
 # Repository Lister Services
 #
 
 class RepoLister (PolicyMixin):
     listers = []
+    # (lister, thread, cached repositories) of listings, which run in
+    # the background (see detach_unfinished)
+    unfinished = []
 
     def __init__(self, cache = None, default_policy = "allow", scm = Git(), name = None,
-                 into = "~/", **kwargs):
+                 into = "~/", cache_ttl = None, background_refresh = True, timeout = 30,
+                 **kwargs):
+        """cache: file where the listed repositories are cached
+cache_ttl: seconds after which the cache is listed again (default: never)
+background_refresh: if the cache is older than cache_ttl, use it for this run
+      and refresh it in the background
+timeout: seconds to wait for the listing at startup (see prefetch), before
+      the (stale) cache is used instead"""
         PolicyMixin.__init__(self, default_policy)
 
         RepoLister.listers.append(self)
@@ -26,7 +42,24 @@ class RepoLister (PolicyMixin):
         else:
             self.cache = None
 
+        self.cache_ttl = cache_ttl
+        self.timeout = timeout
+        # The listed repositories, once the lister was iterated
+        self.repos = None
+        self.background_refresh = background_refresh
+        # Header of the loaded cache file
+        self.cache_header = {}
+        # HTTP validators (ETag, Last-Modified) for conditional requests
+        # from the last listing and from the current one
+        self.validators = {}
+        self.new_validators = {}
+        # Set by get_list, if the remote site didn't change since the
+        # cache was written
+        self.not_modified = False
+
         self.clone_urls = None
+        # Time of the last push for clone urls (if the remote site tells it)
+        self.pushed_at = {}
         self.local_directory = into
 
         # Default source control management is git, but can be changed by more specific listers
@@ -46,6 +79,15 @@ class RepoLister (PolicyMixin):
     def get_list(self):
         pass
 
+    def url_prefix(self):
+        """Common prefix of all clone urls this lister produces (None if
+        unknown). Used to skip listers a selector can't match"""
+        return None
+
+    def path_prefix(self):
+        """Directory all repositories of this lister are cloned into"""
+        return os.path.join(os.path.expanduser(self.local_directory), "")
+
     def create_repos(self):
         repos = []
         for url in self.urls():
@@ -53,37 +95,287 @@ class RepoLister (PolicyMixin):
                 repos.append( Repository(url[0], os.path.join(self.local_directory, url[1]), scm = self.scm, **self.kwargs))
             else:
                 repos.append( Repository(url, into = self.local_directory, scm = self.scm, **self.kwargs))
+        for repo in repos:
+            repo.pushed_at = self.pushed_at.get(repo.clone_url)
         return repos
 
+    # Version of the cache file format, caches with another version
+    # are rebuilt
+    cache_version = 1
+
+    def load_cache(self):
+        """Returns the repositories from the cache file or None, if there
+        is no usable cache. The cache file consists of a header line and
+        one JSON object per repository (see Repository.to_dict)"""
+        import json
+        try:
+            fd = open(self.cache)
+        except OSError:
+            return None
+        with fd:
+            try:
+                header = json.loads(fd.readline())
+            except ValueError:
+                # Cache from an older metagit
+                return None
+            if not isinstance(header, dict) or header.get("version") != self.cache_version:
+                return None
+            self.cache_header = header
+            self.validators = header.get("validators", {})
+            try:
+                repos, scms = [], {}
+                for line in fd:
+                    data = json.loads(line)
+                    # Repositories of one lister share their scm
+                    key = json.dumps(data["scm"], sort_keys = True)
+                    if not key in scms:
+                        scms[key] = SCM.from_dict(data["scm"])
+                    repo = Repository.from_dict(data, scm = scms[key])
+                    repo.listed_at = header.get("created")
+                    repo.listing_ttl = self.cache_ttl
+                    repos.append(repo)
+                return repos
+            except (ValueError, KeyError) as e:
+                sys.stderr.write("WARNING: Invalid cache file: %s (%s)\n" % (self.cache, e))
+                return None
+
+    def save_cache(self, repos):
+        """Writes the repositories to the cache file. The file is replaced
+        atomically, so concurrent metagit runs never see half a cache"""
+        import json
+        directory = os.path.dirname(self.cache) or "."
+        fd, path = tempfile.mkstemp(dir = directory, prefix = ".metagit-cache-")
+        try:
+            with os.fdopen(fd, "w") as cache:
+                cache.write(json.dumps({"version": self.cache_version,
+                                        "lister": self.name,
+                                        "created": time.time(),
+                                        "validators": self.new_validators}) + "\n")
+                for repo in repos:
+                    cache.write(json.dumps(repo.to_dict()) + "\n")
+            os.replace(path, self.cache)
+        except OSError as e:
+            sys.stderr.write("WARNING: Could not write cache file: %s (%s)\n" % (self.cache, e))
+            os.unlink(path)
+
+    def stale(self):
+        """Is the loaded cache older than cache_ttl?"""
+        if self.cache_ttl is None:
+            return False
+        return time.time() - self.cache_header.get("created", 0) > self.cache_ttl
+
+    def refresh(self, cached = None):
+        """Lists the remote site again and rewrites the cache. If the
+        lister finds out, that nothing has changed since the cached
+        repositories were listed, these are kept"""
+        self.clone_urls = None
+        self.not_modified = False
+        self.new_validators = {}
+        listed_at = time.time()
+        repos = self.create_repos()
+        if self.not_modified and cached is not None:
+            self.new_validators = self.validators
+            repos = cached
+        for repo in repos:
+            repo.listed_at = listed_at
+            repo.listing_ttl = self.cache_ttl
+        if self.cache and len (repos) > 0:
+            self.save_cache(repos)
+        return repos
+
+    def __background_refresh(self, cached):
+        try:
+            self.refresh(cached)
+        except Exception as e:
+            sys.stderr.write("WARNING: Refreshing %s failed: %s\n" % (self.name, e))
+
     def __iter__(self):
+        if self.repos is None:
+            with Timings.phase("list " + str(self.name)):
+                self.repos = self.__list()
+        return self.repos.__iter__()
+
+    def __list(self):
         # Check Policy against own FQDN
         if not self.check_policy():
-            return [].__iter__()
+            return []
 
+        cached = None
         if self.cache:
             # There may be a Repository Cache
-            if os.path.exists(self.cache):
-                try:
-                    cache = open(self.cache)
-                    repos = eval(cache.read())
-                    cache.close()
-                    return repos.__iter__()
-                except Exception as e:
-                    print("WARNING: Invalid cache file: " + self.cache)
-                    # Disabling Cache
-                    self.cache = None
-                    print(e)
-
-        # Cache does not exist try to build it
-        repos = self.create_repos()
-        if self.cache and len (repos) > 0:
-            cache = open(self.cache, "w+")
-            cache.write("[%s" % str(repos[0]))
-            for r in repos[1:]:
-                cache.write(",\n %s" % str(r))
-            cache.write("]")
-            cache.close()
-        return repos.__iter__()
+            cached = self.load_cache()
+            if cached is not None and not self.stale():
+                return cached
+
+        if cached is not None and self.background_refresh:
+            # Stale while revalidate: this run uses the old cache. If
+            # the refresh isn't done at exit, it is detached
+            thread = threading.Thread(target = self.__background_refresh, args = (cached,),
+                                      daemon = True)
+            thread.start()
+            self.__unfinished(thread, cached)
+            return cached
+
+        # Cache does not exist (or is stale) try to build it
+        try:
+            return self.refresh(cached)
+        except Exception as e:
+            # Other sets must still be usable (e.g. with an unreachable host)
+            sys.stderr.write("WARNING: Listing %s failed, using %s: %s\n"
+                             % (self.name, "the old cache" if cached else "no repositories", e))
+            return cached or []
+
+    def prefetch(listers = None):
+        """Lists the given repo listers (default: all), which weren't
+        iterated yet, at the same time. Listers that take longer than
+        their timeout are left running in the background; their (stale)
+        cache is used instead. If they are still running, when metagit
+        exits, they are listed again by a detached process (see detach),
+        which writes their cache for the next run"""
+        if listers is None:
+            listers = RepoLister.listers
+        threads = []
+        for lister in listers:
+            if lister.repos is None:
+                thread = threading.Thread(target = lister.__prefetch, daemon = True)
+                thread.start()
+                threads.append((lister, thread))
+
+        start = time.time()
+        for lister, thread in threads:
+            if lister.timeout is None:
+                thread.join()
+            else:
+                thread.join(max(0, start + lister.timeout - time.time()))
+            if thread.is_alive():
+                cached = lister.cache and lister.load_cache()
+                lister.repos = cached or []
+                lister.__unfinished(thread, cached or None)
+                sys.stderr.write("WARNING: Listing %s timed out, using %s; it goes on in the background\n"
+                                 % (lister.name, "the old cache" if lister.repos else "no repositories"))
+    prefetch = staticmethod(prefetch)
+
+    def __unfinished(self, thread, cached):
+        if not RepoLister.unfinished:
+            atexit.register(RepoLister.detach_unfinished)
+        RepoLister.unfinished.append((self, thread, cached))
+
+    def detach_unfinished():
+        """Called at exit: background listings are daemon threads, which
+        don't keep metagit running. Those, which haven't finished yet,
+        are started again in a detached process"""
+        for lister, thread, cached in RepoLister.unfinished:
+            if thread.is_alive():
+                lister.detach(cached)
+    detach_unfinished = staticmethod(detach_unfinished)
+
+    def detach(self, cached = None):
+        """Refreshes the cache (see refresh) in a process, which is
+        detached from this metagit run. It doesn't inherit the output
+        either, so $(metagit cd x) doesn't wait for it"""
+        if not self.cache or not hasattr(os, "fork"):
+            return
+        try:
+            pid = os.fork()
+        except OSError:
+            return
+        if pid:
+            os.waitpid(pid, 0)
+            return
+        # The child forks again, so the listing process is no zombie
+        # of this one (it is inherited by init)
+        status = 1
+        try:
+            os.setsid()
+            null = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(null, fd)
+            if os.fork() == 0:
+                # The connections of this process must not be shared
+                from gmp.httpclient import HTTPClient
+                HTTPClient.instance = None
+                self.refresh(cached)
+            status = 0
+        finally:
+            os._exit(status)
+
+    def __prefetch(self):
+        try:
+            with Timings.phase("list " + str(self.name)):
+                repos = self.__list()
+        except Exception as e:
+            # The lister must not be listed again (by __iter__)
+            repos = (self.cache and self.load_cache()) or []
+            sys.stderr.write("WARNING: Listing %s failed, using %s: %s\n"
+                             % (self.name, "the old cache" if repos else "no repositories", e))
+        # After a timeout, this run uses the cache loaded by prefetch
+        if self.repos is None:
+            self.repos = repos
+
+    def http_get(self, url, headers = {}, conditional = True):
+        """Fetches url (with a conditional request, if it was fetched for
+        the cache before). Returns the body and the response headers.
+        The body is None, if it wasn't modified since then"""
+        from gmp.httpclient import HTTPClient, HTTPError
+        headers = dict(headers)
+        validators = self.validators.get(url, {})
+        if conditional and "etag" in validators:
+            headers["If-None-Match"] = validators["etag"]
+        if conditional and "last_modified" in validators:
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+        status, response, body = HTTPClient.get().request(url, headers)
+        if status == 304:
+            self.new_validators[url] = validators
+            return None, response
+        if status >= 300:
+            raise HTTPError(url, status)
+
+        validators = {}
+        if response.get("ETag"):
+            validators["etag"] = response["ETag"]
+        if response.get("Last-Modified"):
+            validators["last_modified"] = response["Last-Modified"]
+        self.new_validators[url] = validators
+        return body, response
+
+    # Number of pages of an API listing, which are fetched at once
+    page_workers = 8
+
+    def http_get_pages(self, url, pages, headers = {}):
+        """Fetches all pages of a paginated API listing. pages(response)
+        returns the number of pages from the headers of the first page;
+        all other pages are then fetched concurrently. Returns the list
+        of bodies or None, if no page changed since the cache was written"""
+        import concurrent.futures
+        page_url = lambda n: "%s%spage=%d" % (url, "&" if "?" in url else "?", n)
+        fetch = lambda page, conditional = True: self.http_get(page, headers, conditional)[0]
+
+        first, response = self.http_get(page_url(1), headers)
+        if first is None:
+            # The other pages of the last listing may have changed as well
+            known = [x for x in self.validators if x.startswith(url) and x != page_url(1)]
+            with concurrent.futures.ThreadPoolExecutor(self.page_workers) as pool:
+                if all(body is None for body in pool.map(fetch, known)):
+                    return None
+            first = fetch(page_url(1), conditional = False)
+
+        others = [page_url(n) for n in range(2, pages(response) + 1)]
+        with concurrent.futures.ThreadPoolExecutor(self.page_workers) as pool:
+            bodies = list(pool.map(fetch, others))
+        # Unmodified pages have no body, but others did change
+        bodies = [body if body is not None else fetch(page, conditional = False)
+                  for page, body in zip(others, bodies)]
+        return [first] + bodies
+
+    def last_page(response):
+        """Number of the last page from a HTTP Link header (RFC 5988)"""
+        for link in (response.get("Link") or "").split(","):
+            m = re.search("[?&]page=(\\d+)[^>]*>;\\s*rel=\"last\"", link)
+            if m:
+                return int(m.group(1))
+        return 1
+    last_page = staticmethod(last_page)
 
     def can_upload(self):
         """Returns True if the Repository Lister is able to move a repository from local to this site
@@ -93,32 +385,53 @@ If it returns True, it must have an attribute name and a method upload(self, loc
 class SSHDir(RepoLister):
     """With you can create SSHDir a list of git repositories on an remote host"""
 
-    def __init__(self, host, directory, **kwargs):
+    def __init__(self, host, directory, depth = 4, **kwargs):
         """host: ssh login used with ssh
-directory: remote directory where the git repos are searched"""
+directory: remote directory where the git repos are searched
+depth: how many directory levels below directory are searched"""
         RepoLister.__init__(self, **kwargs)
         self.host = host
         self.directory = directory
+        self.depth = depth
 
         if not self.name:
             self.name = host
 
+    def url_prefix(self):
+        return self.host + ":" + self.directory
+
+    def find_command(self):
+        """The remote find prints only the roots of repositories and
+        never descends into them. Bare repositories are found by their
+        refs directory, except for the refs inside logs and svn"""
+        dot_dir = "." + self.scm.binary
+        return ["find", self.directory, "-maxdepth", str(self.depth), "-type", "d",
+                "(", "-name", dot_dir, "-print", "-prune",
+                "-o", "-path", "*/logs/refs", "-prune",
+                "-o", "-path", "*/svn/refs", "-prune",
+                "-o", "-name", "refs", "-print", "-prune",
+                "-o", "-path", "*/objects/??", "-prune",
+                "-o", "-path", "*/objects/pack", "-prune", ")"]
 
     def get_list(self):
-        process = subprocess.Popen(["ssh", self.host, "find", self.directory,
-                                    "-maxdepth", "4", "-type", "d"],
+        # ssh passes the command to the remote shell
+        command = " ".join([shlex.quote(x) for x in self.find_command()])
+        process = subprocess.Popen(["ssh", self.host, command],
                                    stdout = subprocess.PIPE,
-                                   stderr = subprocess.PIPE)
-        process.stderr.close()
+                                   stderr = subprocess.DEVNULL)
+        suffix = re.compile("/(\\.%s|refs)$" % re.escape(self.scm.binary))
         self.clone_urls = []
-        for repo in process.stdout.readlines():
-            # Finding none bare repositories
-            m = re.match("^(.*)/\.%s$" % self.scm.binary, repo)
-            m = m or re.match("(.*)/refs$", repo)
-            if m and not re.match(".*(svn|logs)/refs", repo) and not re.match(".*\.%s/" % self.scm.binary, repo):
-                remote = m.group(1)
+        for line in process.stdout:
+            line = line.decode(errors = "replace").rstrip("\n")
+            m = suffix.search(line)
+            if m:
+                remote = line[:m.start()]
                 local = remote[len(self.directory)+1:]
                 self.clone_urls.append((self.host + ":" + remote, local))
+        if process.wait() == 255:
+            # 255 is ssh's own error; find fails with 1 on unreadable
+            # directories, but the listing of the rest is still good
+            raise OSError("ssh %s failed (host unreachable?)" % self.host)
 
     def can_upload(self):
         """You can upload a repository to a remote site"""
@@ -150,6 +463,9 @@ class Gitolite(RepoLister):
         RepoLister.__init__(self, **kwargs)
         self.host = host
 
+    def url_prefix(self):
+        return self.host + ":"
+
     def get_list(self):
         process = subprocess.Popen(["ssh", self.host, "expand"],
                                    stdout = subprocess.PIPE)
@@ -175,10 +491,14 @@ class Gitolite(RepoLister):
 
 
 class Github(RepoLister):
-    def __init__(self, username = None, protocol="ssh", wiki = False, **kwargs):
+    # Base url of the API (differs for Github Enterprise)
+    api = "https://api.github.com"
+
+    def __init__(self, username = None, protocol="ssh", wiki = False, org = None, **kwargs):
         """Uses a github account name to get a list of repositories
 username: github.com username (can be derived from github.user)
-protocol: used for cloning the repository (choices: ssh/https/git)"""
+protocol: used for cloning the repository (choices: ssh/https/git)
+org: list the repositories of this organisation instead of the user's"""
         # GIThub!!!!
         kwargs['scm'] = Git()
         if not 'name' in kwargs or not kwargs['name']:
@@ -197,33 +517,51 @@ protocol: used for cloning the repository (choices: ssh/https/git)"""
                                        stderr = subprocess.PIPE)
             process.stderr.close()
             username = process.stdout.readline().decode().strip()
-            if username == "":
+            if username == "" and not org:
                 print("""ERROR: No username defined for Github lister, please define github.user
     via git config or put it into the config file""")
                 sys.exit(-1)
-            self.username = username
+            self.username = username or None
 
+        self.org = org
+        self.owner = org or self.username
         self.protocol = protocol
 
     def get_list(self):
-        js = urllib.request.urlopen("https://api.github.com/users/%s/repos"%self.username).read()
-        repos = json.loads(js)
+        import json, calendar
+        if self.org:
+            url = "%s/orgs/%s/repos?per_page=100" % (self.api, self.org)
+        else:
+            url = "%s/users/%s/repos?per_page=100" % (self.api, self.username)
+        pages = self.http_get_pages(url, RepoLister.last_page)
         self.clone_urls = []
-        for repo in repos:
-            name = repo["name"]
-            wiki = repo["has_wiki"]
-            self.clone_urls.append(self.github_url(name))
-            if self.wiki and wiki:
-                self.clone_urls.append((self.github_url(name + ".wiki"), name + "/" + self.wiki))
+        if pages is None:
+            self.not_modified = True
+            return
+        for js in pages:
+            for repo in json.loads(js):
+                name = repo["name"]
+                wiki = repo["has_wiki"]
+                self.clone_urls.append(self.github_url(name))
+                if repo.get("pushed_at"):
+                    self.pushed_at[self.github_url(name)] = calendar.timegm(
+                        time.strptime(repo["pushed_at"], "%Y-%m-%dT%H:%M:%SZ"))
+                if self.wiki and wiki:
+                    self.clone_urls.append((self.github_url(name + ".wiki"), name + "/" + self.wiki))
+
+    def url_prefix(self):
+        return self.github_url("")[:-len(".git")]
 
     def github_url(self, name):
         url = ""
         if self.protocol == "ssh":
-            url = "git@github.com:%s/%s.git" % (self.username, name)
+            url = "git@github.com:%s/%s.git" % (self.owner, name)
+        elif self.protocol == "https" and self.username:
+            url = "https://%s@github.com/%s/%s.git" %(self.username, self.owner, name)
         elif self.protocol == "https":
-            url = "https://%s@github.com/%s/%s.git" %(self.username, self.username, name)
+            url = "https://github.com/%s/%s.git" %(self.owner, name)
         else:
-            url = "git://github.com/%s/%s.git" %(self.username, name)
+            url = "git://github.com/%s/%s.git" %(self.owner, name)
         return url
 
     def can_upload(self):
@@ -233,6 +571,7 @@ protocol: used for cloning the repository (choices: ssh/https/git)"""
     def upload(self, local, remote):
         """Creates a new repository at github and pushes the local one to it.
 Please set the github.token variable via git config"""
+        import urllib.parse, urllib.request
         cmd = "git config --get github.token"
         print(cmd)
         process = subprocess.Popen(cmd, shell = True,
@@ -275,6 +614,9 @@ postfix: e.g trunk, will be appended to the clone url"""
         self.svn_repo = svn_repo
         self.postfix = postfix
 
+    def url_prefix(self):
+        return self.svn_repo
+
     def get_list(self):
         process = subprocess.Popen(["svn", "list", self.svn_repo],
                                    stdout = subprocess.PIPE)
@@ -300,6 +642,7 @@ protocol: used for cloning the repository (choices: ssh/http/git)"""
         self.gitorious = gitorious
 
     def get_list(self):
+        import urllib.request
         print("http://%s/~%s"%(self.gitorious, self.username))
         site = urllib.request.urlopen("https://%s/~%s"%(self.gitorious, self.username))
         lines_to_read = 0
@@ -327,10 +670,11 @@ protocol: used for cloning the repository (choices: ssh/http/git)"""
                 lines_to_read -= 1
 
 class Gitlab(RepoLister):
-    def __init__(self, host = None, **kwargs):
-        """Uses a gitlab account name to get a list of repositories
-username: gitl username (can be derived from github.user)
-protocol: used for cloning the repository (choices: ssh/https/git)"""
+    def __init__(self, host = None, group = None, **kwargs):
+        """Uses a gitlab access token (git config gitlab.<host>.token) to
+get a list of repositories
+host: the gitlab server
+group: list the projects of this group (and its subgroups) instead of the owned ones"""
         # GIThub!!!!
         kwargs['scm'] = Git()
         if not 'name' in kwargs or not kwargs['name']:
@@ -342,23 +686,42 @@ protocol: used for cloning the repository (choices: ssh/https/git)"""
                                    stdout = subprocess.PIPE,
                                    stderr = subprocess.PIPE)
         process.stderr.close()
-        token = process.stdout.readline().strip()
+        token = process.stdout.readline().decode().strip()
         if token == "":
-            print("""ERROR: No gitlab token defined. Please define gitlab.token defined for Github lister, please define github.user
-            via git config or put it into the config file""")
+            print("""ERROR: No gitlab token defined. Please define gitlab.%s.token
+            via git config""" % host)
             sys.exit(-1)
 
         self.gitlab_token = token
         self.host = host
+        self.group = group
+
+    def pages(response):
+        if response.get("X-Total-Pages"):
+            return int(response["X-Total-Pages"])
+        # Gitlab omits the header for very large listings
+        return RepoLister.last_page(response)
+    pages = staticmethod(pages)
 
     def get_list(self):
+        import json, urllib.parse
         headers = {"PRIVATE-TOKEN": self.gitlab_token}
-        url = "https://%s/api/v3/projects/owned" % self.host
-        request = urllib.request.Request(url, headers=headers)
-        js = urllib.request.urlopen(request).read()
-        repos = json.loads(js)
+        if self.group:
+            url = "https://%s/api/v4/groups/%s/projects?include_subgroups=true&per_page=100" \
+                  % (self.host, urllib.parse.quote(self.group, safe = ""))
+        else:
+            url = "https://%s/api/v4/projects?owned=true&per_page=100" % self.host
+        pages = self.http_get_pages(url, Gitlab.pages, headers = headers)
         self.clone_urls = []
-        for repo in repos:
-            name = repo["name"]
-            ssh_url = repo["ssh_url_to_repo"]
-            self.clone_urls.append((ssh_url, name))
+        if pages is None:
+            self.not_modified = True
+            return
+        for js in pages:
+            for repo in json.loads(js):
+                name = repo["name"]
+                path = repo["path_with_namespace"]
+                if self.group and path.startswith(self.group + "/"):
+                    # Projects in subgroups are cloned into subdirectories
+                    name = path[len(self.group) + 1:]
+                ssh_url = repo["ssh_url_to_repo"]
+                self.clone_urls.append((ssh_url, name))
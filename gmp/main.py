@@ -1,17 +1,24 @@
 import os
-from socket import getfqdn
 import re
 import sys
 import subprocess
 import optparse
+import tempfile
+import time
 
 # Project specify
 from gmp.policy import *
 from gmp.repository import *
 from gmp.listers import *
 from gmp.tools import *
+from gmp.scheduler import *
 from gmp.scm import *
+from gmp.selector import *
 from gmp.options import *
+from gmp.timings import *
+from gmp.daemon import *
+from gmp.index import *
+from gmp.frecency import *
 
 #
 # The Repository manager
@@ -21,24 +28,40 @@ class RepoManager:
     """Manages all repositories and provides the command line interface"""
     sets = {}
 
+    changed_help = """[selector] - executes <scm> %s on repositories
+With --changed only repositories whose branches or tags differ from the
+remote site are used (compared with ls-remote or the listers push time)"""
+
+    def hostname(self):
+        return local_hostname()
+    hostname = property(hostname)
+
     def __init__(self):
-        self.hostname = getfqdn()
         self.commands = {"list": self.cmd_list,
                          "clone": self.cmd_clone,
                          "upload": self.cmd_upload,
                          "foreach": self.cmd_foreach,
-                         "status" : self.shortcut("status"),
+                         "status" : self.cmd_status,
                          "commit" : self.shortcut("commit"),
                          "push" : self.shortcut("push"),
-                         "pull" : self.shortcut("pull"),
-                         "fetch" : self.shortcut("fetch"),
+                         "pull" : self.shortcut("pull", help = self.changed_help % "pull"),
+                         "fetch" : self.shortcut("fetch", help = self.changed_help % "fetch"),
                          "diff" : self.shortcut("diff"),
                          "cd"    : self.cmd_cd,
+                         "mirror": self.cmd_mirror,
+                         "daemon": self.cmd_daemon,
+                         "complete": self.cmd_complete,
                          "clean" : self.cmd_clean}
 
-        # Translation table for short commands
+        # The configuration file (set by bin/metagit)
+        self.conffile = None
+        # Are the sets restored from a snapshot (see load_snapshot)?
+        self.restored = False
+
+        # Translation table for short commands (and for prefixes, which
+        # were unique before daemon and complete were added)
         # FIXME: not documentated anywhere
-        self.short_commands = {'c': 'clone'}
+        self.short_commands = {'c': 'clone', 'd': 'diff', 'co': 'commit', 'com': 'commit'}
 
     def __call__(self):
         """The Reposity Manager can be called in order to start the command
@@ -49,6 +72,15 @@ line interface"""
             Options.instance.parser.print_help()
             return
 
+        try:
+            with Timings.phase("command " + args[0]):
+                self.dispatch(args)
+            self._update_index()
+        finally:
+            if Options.opt("timings") or Options.opt("profile"):
+                Timings.report(Options.opt("profile"), Options.opt("timings"))
+
+    def dispatch(self, args):
         # Use prefixing to do short commands
         short = [x for x in list(self.commands.keys()) if x.startswith(args[0])]
         if len(short) == 1:
@@ -71,6 +103,9 @@ line interface"""
         text += """
   A selector is a regexp which is checked against the output of metagit
   list. (Exception: states (%s), current repository (.).
+  Fields can be matched with set:<name>, scm:<name>, url:<regexp> and
+  path:<regexp>; terms can be negated with ! and combined with ` & '
+  and ` | ', e.g. "+ & set:uni".
 
 """ %(", ".join(SCM.states))
 
@@ -101,38 +136,173 @@ line interface"""
 
 
     def add_set(self, set_name, repo_list):
-        """You can add a list of repositories to a set"""
+        """You can add a list of repositories to a set. Repo listers are
+        kept in the set and only listed, when a selector can match
+        their repositories"""
         # Make it possible to use add_set without a list
-        if not isinstance(repo_list, (list,tuple, RepoLister)):
+        if not isinstance(repo_list, (list,tuple)):
             repo_list = [repo_list]
 
         if not set_name in self.sets:
             self.sets[set_name] = []
 
-        for repo in list(repo_list):
-            repo.set.append(set_name)
+        for repo in repo_list:
+            if not isinstance(repo, RepoLister):
+                repo.set.append(set_name)
             self.sets[set_name].append(repo)
 
-    def _select(self, selector, state = None):
-        # If the selector is a state, it will be searched only at the beginning
-        if selector in SCM.states:
-            selector = "^\\" + selector
+    # Builtin commands, which can be answered from a snapshot of the sets
+    snapshot_commands = ["list", "cd"]
+    snapshot_version = 1
+
+    def load_snapshot(self, path, conffile):
+        """Restores the sets from the snapshot at path (see save_snapshot).
+        Returns False, if there is none or if it is outdated"""
+        import pickle
+        try:
+            with open(path, "rb") as fd:
+                header = pickle.load(fd)
+                if header.get("version") != self.snapshot_version \
+                   or header.get("config") != os.path.abspath(conffile):
+                    return False
+                if self._outdated(header["files"], header["expires"]):
+                    return False
+                self.sets = pickle.load(fd)
+        except Exception:
+            # Missing, broken or from another metagit version
+            return False
+        self.restored = True
+        return True
+
+    def save_snapshot(self, path, conffile):
+        """Lists all repo listers and stores the resulting sets at path.
+        The snapshot is outdated, as soon as the configuration file or
+        a cache file of a lister changes, or a cache expires"""
+        import pickle
+        if any([lister.cache is None for lister in RepoLister.listers]):
+            # Without a cache, the lister would list on every run
+            return
+        list(self._repos())
+
+        repos = [repo for s in self.sets for repo in self.sets[s]]
+        if any([type(x).__module__ == "config" for repo in repos for x in (repo, repo.scm)]):
+            # Classes from the configuration can't be restored without it
+            return
+        files, expires = self._config_files(conffile)
+        header = {"version": self.snapshot_version,
+                  "config": os.path.abspath(conffile),
+                  "files": files,
+                  "expires": expires}
+        try:
+            fd, tmp = tempfile.mkstemp(dir = os.path.dirname(path) or ".", prefix = ".metagit-snapshot-")
+            with os.fdopen(fd, "wb") as snapshot:
+                pickle.dump(header, snapshot)
+                pickle.dump(self.sets, snapshot, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except OSError as e:
+            sys.stderr.write("WARNING: Could not write snapshot: %s (%s)\n" % (path, e))
+
+    def _config_files(self, conffile):
+        """Returns the modification times of the configuration file and
+        of the lister caches (None for missing files) and the time the
+        first cache expires (or None). The caches are written, when
+        the listers have listed"""
+        files = {}
+        for name in [conffile] + [lister.cache for lister in RepoLister.listers if lister.cache]:
+            files[name] = mtime(name)
+        expires = [files[lister.cache] + lister.cache_ttl for lister in RepoLister.listers
+                   if lister.cache and lister.cache_ttl is not None
+                   and files[lister.cache] is not None]
+        if not expires:
+            return files, None
+        return files, min(expires)
+
+    def _outdated(self, files, expires):
+        """Did one of the files (see _config_files) change or expire?"""
+        if expires is not None and time.time() > expires:
+            return True
+        return any([mtime(name) != value for name, value in files.items()])
+
+    def update_index(self):
+        """Lists all repo listers and rewrites the index (see RepoIndex)"""
         repos = []
+        seen = set()
+        for s, repo in self._repos():
+            if not id(repo) in seen and repo.check_policy():
+                seen.add(id(repo))
+                repos.append(repo)
+        StateCache.prime(repos)
+        files, expires = self._config_files(self.conffile)
+        RepoIndex().write(self.conffile, files, sorted(self.commands.keys()), repos)
+
+    def _update_index(self, force = False):
+        """Keeps an existing index up to date: it is rewritten after
+        clones (force) and when a lister cache or the configuration
+        changed. Listers without a cache are never listed for this"""
+        if not self.conffile or self.restored:
+            return
+        index = RepoIndex()
+        if not index.exists() or (not force and index.fresh(self.conffile)):
+            return
+        if all([lister.repos is not None or (lister.cache and os.path.exists(lister.cache))
+                for lister in RepoLister.listers]):
+            self.update_index()
+
+    def _repos(self, may_match = lambda set_name, lister: True):
+        """Yields (set name, repository) for all repositories in all sets.
+        Repo listers are listed (concurrently), if may_match(set_name,
+        lister) says they can contain interesting repositories, and are
+        skipped otherwise"""
+        listers = [(s, x) for s in self.sets for x in self.sets[s]
+                   if isinstance(x, RepoLister) and may_match(s, x)]
+        RepoLister.prefetch([lister for s, lister in listers])
+
+        # Replace the listed repo listers by their repositories
+        for s, lister in listers:
+            index = self.sets[s].index(lister)
+            repos = list(lister)
+            for repo in repos:
+                repo.set.append(s)
+            self.sets[s][index:index + 1] = repos
 
         for s in list(self.sets.keys()):
             for repo in self.sets[s]:
-                if selector == ".":
-                    if os.path.exists(repo.local_url) and os.path.abspath(os.curdir).startswith(repo.local_url):
-                        repos.append(repo)
-                elif (selector == "all" or re.search(selector, repo.status_line(), re.IGNORECASE)) \
-                        and repo.check_policy(self.hostname):
-                    if not state or repo.get_state() in state:
-                        repos.append(repo)
-
-        if selector == "." and len(repos) > 0:
+                if not isinstance(repo, RepoLister):
+                    yield (s, repo)
+
+    def _select(self, selector, state = None):
+        """Returns all repositories matching the selector (see Selector)
+        in the order of their sets. Repositories in several sets are
+        returned only once"""
+        repos = []
+        seen = set()
+
+        if selector == ".":
+            cwd = os.path.join(os.path.abspath(os.curdir), "")
+            # Only repo listers which clone into a parent of cwd are listed
+            in_cwd = lambda set_name, lister: cwd.startswith(lister.path_prefix())
+            for s, repo in self._repos(in_cwd):
+                if os.path.exists(repo.local_url) and cwd.startswith(os.path.join(repo.local_url, "")):
+                    repos.append(repo)
             # Take the closest match
-            repos = [sorted(repos, lambda a, b: len(b.local_url) - len(a.local_url))[0]]
+            if len(repos) > 0:
+                repos = [max(repos, key = lambda repo: len(repo.local_url))]
+            return repos
+
+        match = Selector(selector)
+        candidates = list(self._repos(match.may_match))
+        begin = time.perf_counter()
+        StateCache.prime([repo for s, repo in candidates])
 
+        for s, repo in candidates:
+            if id(repo) in seen:
+                continue
+            if match(repo) and repo.check_policy():
+                if not state or repo.get_state() in state:
+                    seen.add(id(repo))
+                    repos.append(repo)
+
+        Timings.record("select", begin, time.perf_counter())
         return repos
 
     def cmd_list(self, selector):
@@ -144,20 +314,59 @@ line interface"""
             print(repo.status_line())
 
     def cmd_clone(self, selector):
-        """[selector] - clones all matching repos"""
+        """[selector] - clones all matching repos
+With --parallel every repository is locked (if read_only) as soon as its
+clone is done. With --reference objects are copied from the local mirror"""
         if len(selector) == 0:
             selector = ["all"]
 
         repos = self._select(selector[0])
+        scheduler = Scheduler.get()
+        cloned = []
         for repo in repos:
+            if os.path.exists(repo.local_url):
+                continue
             directory = os.path.dirname(repo.local_url)
             if not os.path.exists(directory):
                 print(("mkdir -p " + directory))
                 os.makedirs(directory)
-            if os.path.exists(repo.local_url):
+            jobs = repo.execute("clone", [repo.clone_url, repo.local_url] + selector[1:])
+            jobs = [job for job in jobs or [] if job]
+            if jobs:
+                scheduler.then(jobs, self.__cloned(repo))
+            cloned.append(repo)
+
+        jobs = scheduler.run()
+        Session.execute()
+        self._report(jobs)
+        for repo in cloned:
+            StateCache.invalidate(repo.local_url)
+        if cloned:
+            self._update_index(force = True)
+
+    def __cloned(self, repo):
+        def lock(jobs):
+            if all(job.returncode == 0 for job in jobs):
+                repo.lock()
+        return lock
+
+    def cmd_mirror(self, args):
+        """[selector] - creates or updates the local mirrors (see --mirrors)
+Bare mirrors are cloned once and updated with fetch --prune afterwards.
+clone --reference and clone/fetch/pull --from-mirror use them"""
+        directory = Options.opt('mirrors')
+        for repo in self._select(self._shortcut(args)[0]):
+            if not repo.scm.mirrors:
                 continue
-            repo.execute("clone", [repo.clone_url, repo.local_url] + selector[1:])
-            repo.lock()
+            mirror = repo.mirror_path(directory)
+            if os.path.exists(mirror):
+                repo.scm.execute("fetch", ["--prune"], destdir = mirror,
+                                 remote = repo.clone_url)
+            else:
+                repo.scm.execute("clone", [repo.clone_url, mirror, "--mirror"])
+        jobs = Scheduler.get().run()
+        Session.execute()
+        self._report(jobs)
 
     def _shortcut(self, args):
         if len(args) == 0:
@@ -192,30 +401,118 @@ executes `<scm> <command>' on matching repositories"""
         repos = self._select(args[0])
         repos = [repo for repo in repos
                  if repo.get_state() in [SCM.STATE_EXISTS, SCM.STATE_BARE]]
+        if Options.opt("changed") and args[1] in ["fetch", "pull"]:
+            repos = self._changed(repos)
 
-        # Make RW if readonly
-        for repo in repos:
+        # Make RW if readonly (unless the command only reads)
+        unlocked = [repo for repo in repos
+                    if not args[1] in repo.scm.read_only_commands]
+        for repo in unlocked:
             repo.unlock()
 
-        processes = []
-
         for repo in repos:
-            # Give arguments to deeper layers and save the resulting processes
-            process_list = repo.execute(args[1], args[2:])
-            processes.extend(process_list)
+            # Give arguments to deeper layers, in parallel mode the
+            # resulting jobs are queued in the scheduler
+            for job in repo.execute(args[1], args[2:]):
+                if isinstance(job, Job):
+                    job.repo = repo
 
-        for p in processes:
-            if p and "wait" in dir(p):
-                p.wait()
-        ScreenExecutor.execute()
+        if Options.opt("parallel") or Session.get():
+            jobs = Scheduler.get().run()
+            Session.execute()
+            self._report(jobs)
 
         # Make R/O if readonly
-        for repo in repos:
+        for repo in unlocked:
             repo.lock()
 
+    def _report(self, jobs):
+        """Prints a summary of the failed jobs"""
+        failed = [job for job in jobs if job.returncode != 0]
+        if failed:
+            sys.stderr.write("%d of %d jobs failed:\n" % (len(failed), len(jobs)))
+            for job in failed:
+                sys.stderr.write("  [%d] %s\n" % (job.returncode, job.name()))
+        elif jobs and Session.instance:
+            print("All %d jobs succeeded" % len(jobs))
+
+    def _changed(self, repos):
+        """Returns the repositories, whose remote site changed since the
+        last fetch. The refs of all remote sites are listed in parallel"""
+        scheduler = Scheduler.get()
+        checks = []
+        for repo in repos:
+            changed = repo.pushed_since_fetch()
+            url = (Options.opt("from_mirror") and repo.local_mirror()) or repo.clone_url
+            command = repo.scm.remote_refs_command(url)
+            job = None
+            if changed is None and command:
+                job = Job(command, echo = False, capture = True, show = False)
+                job.remote(url)
+                job.repo = repo
+                scheduler.submit(job)
+            checks.append((repo, changed, job))
+        scheduler.run()
+
+        result = []
+        for repo, changed, job in checks:
+            if job and job.returncode == 0:
+                refs = repo.scm.parse_remote_refs(job.read())
+                changed = repo.scm.remote_changed(repo.local_url, refs)
+            elif job:
+                sys.stderr.write("%s failed (%s), assuming a change\n" % (job.display(), job.status()))
+            if changed is not False:
+                result.append(repo)
+        print("%d of %d repositories changed" % (len(result), len(repos)))
+        return result
+
+    def cmd_status(self, args):
+        """[selector] - executes <scm> status on repositories
+With --fast only branch, commits ahead/behind upstream and the number
+of changed files are printed, computed in parallel for all repositories"""
+        fast = Options.opt("fast")
+        if "--fast" in args:
+            args.remove("--fast")
+            fast = True
+        args = self._shortcut(args)
+        if not fast:
+            return self.cmd_foreach([args[0], "status"] + args[1:])
+
+        scheduler = Scheduler.get()
+        summary = []
+        for repo in self._select(args[0]):
+            state = repo.get_state()
+            command = repo.scm.status_command()
+            job = None
+            if state == SCM.STATE_EXISTS and command:
+                job = scheduler.submit(Job(command, echo = False, capture = True,
+                                           show = False, cwd = repo.local_url))
+            summary.append((repo, state, job))
+        scheduler.run()
+
+        format = "%s %-24s %6s %6s %7s  %s"
+        print(format % (" ", "branch", "ahead", "behind", "changes", "repository"))
+        for repo, state, job in summary:
+            status = {}
+            if job and job.returncode == 0:
+                status = repo.scm.parse_status(job.read())
+            elif state in [SCM.STATE_EXISTS, SCM.STATE_BARE]:
+                status = {"branch": repo.scm.head(repo.local_url)}
+            print(format % (state, status.get("branch") or "",
+                            status.get("ahead", ""), status.get("behind", ""),
+                            status.get("changes", ""), repo.short_local_url()))
+
     def cmd_clean(self, args):
-        """deletes all repo lister cache files"""
+        """[RepoLister...] - deletes the cache files of the given
+repo listers (default: of all repo listers)"""
+        names = [lister.name for lister in RepoLister.listers]
+        for name in args:
+            if not name in names:
+                self.die("Available RepoListers: " + ", ".join([str(x) for x in names]))
+
         for lister in RepoLister.listers:
+            if args and not lister.name in args:
+                continue
             if lister.cache:
                 try:
                     os.unlink(lister.cache)
@@ -224,31 +521,76 @@ executes `<scm> <command>' on matching repositories"""
 
     def cmd_cd(self, args):
         """[selector] - prints cd command to change to repository
-If more then one repository is selected, a interactive dialog
-will be shown to select from the matching ones"""
+A name is matched fuzzily against the names and paths of all cloned
+repositories; the best match (then the most often and recently used
+one) is taken. Only if several are equally good, a dialog will be
+shown to select from them. Other selectors work like in list"""
         if len(args) == 0:
             print("echo Please specify target repository")
             return
-        repos = self._select(args[0], state = [SCM.STATE_EXISTS, SCM.STATE_BARE])
-        if len(repos)  == 1:
-            print("cd " + esc(repos[0].local_url))
-        elif len(repos) > 1:
-            for r in range(1, len(repos)+1):
-                sys.stderr.write("%d. %s\n" %(r,repos[r-1].local_url))
-
+        frecency = Frecency()
+        if re.match("^[\\w.~/-]+$", args[0]) and args[0] != ".":
+            local_urls, candidates = rank(args[0], self._local_urls(), frecency)
+        else:
+            repos = self._select(args[0], state = [SCM.STATE_EXISTS, SCM.STATE_BARE])
+            local_urls, candidates = rank(None, [repo.local_url for repo in repos], frecency)
 
+        if len(local_urls) == 0:
+            print("echo No corresponding repository found")
+            return
+        if candidates == 1:
+            local_url = local_urls[0]
+        else:
+            for r in range(1, candidates + 1):
+                sys.stderr.write("%d. %s\n" % (r, local_urls[r - 1]))
             sys.stderr.write("\nSelect Repository: ")
             try:
-                select = eval(input())
-            except:
+                select = int(input())
+            except TerminalRequired:
+                raise
+            except (ValueError, EOFError, KeyboardInterrupt):
                 return
-            if select <= len(repos):
-                print("cd " + esc(repos[select - 1].local_url))
-            else:
+            if select < 1 or select > candidates:
                 print("echo Selection out of range")
-        else:
-            print("echo No correspongding repository found")
-
+                return
+            local_url = local_urls[select - 1]
+        frecency.record(local_url)
+        print("cd " + esc(local_url))
+
+    def _local_urls(self):
+        """The local urls of all cloned repositories. If the index (see
+        RepoIndex) is up to date, all indexed repositories are returned
+        instead: their states may have changed since it was written,
+        rank only takes the existing ones"""
+        index = RepoIndex()
+        if self.conffile and index.fresh(self.conffile):
+            return [repo["local_url"] for repo in index.repositories()]
+        repos = self._select("all", state = [SCM.STATE_EXISTS, SCM.STATE_BARE])
+        return [repo.local_url for repo in repos]
+
+    def cmd_daemon(self, args):
+        """- answers list, cd and status --fast from memory
+Listens on $METAGIT_SOCKET (default: $XDG_RUNTIME_DIR/metagit-<uid>.sock
+or /tmp/metagit-<uid>/metagit.sock)
+until it is terminated; metagit asks the daemon first, as long as it
+runs. Set $METAGIT_NO_DAEMON to bypass it"""
+        if not self.conffile:
+            self.die("The daemon needs a configuration file")
+        Daemon(self, self.conffile).serve()
+
+    def cmd_complete(self, args):
+        """[command] <prefix> - prints the selector words (or commands)
+starting with prefix, for shell completion. They are looked up in the
+index ($METAGIT_INDEX, default: ~/.metagit-index), which is built on
+the first use and kept up to date by clone and lister refreshes"""
+        if len(args) > 2 or (len(args) == 2 and args[0] != "command"):
+            self.die("Usage: complete [command] <prefix>")
+        if not self.conffile:
+            self.die("The index needs a configuration file")
+        index = RepoIndex()
+        if not index.fresh(self.conffile):
+            self.update_index()
+        index.complete(args)
 
     def cmd_upload(self, args):
         """<RepoLister> <LocalRepo> <RemoteRepo>
@@ -290,12 +632,10 @@ RepoLister name (e.g. an SSHDir)"""
 
         # Changing the origin remote
         if origin:
-            cmd = "cd %s; git remote rm origin; git remote add origin %s" \
-                  %(esc(repo.local_url),
-                    esc(repo.clone_url))
-            print(cmd)
-            a = subprocess.Popen(cmd, shell = True)
-            a.wait()
+            for cmd in [["git", "remote", "rm", "origin"],
+                        ["git", "remote", "add", "origin", repo.clone_url]]:
+                print("cd %s; %s" % (esc(repo.local_url), " ".join([esc(x) for x in cmd])))
+                subprocess.call(cmd, cwd = repo.local_url)
 
 # Initialize the repo manager, this will be available in .metagitrc
 manager = RepoManager()
@@ -1,4 +1,5 @@
 import optparse
+import os
 
 class CommandHelpFormatter(optparse.IndentedHelpFormatter):
     """Just returns the epilog without reformatting"""
@@ -20,7 +21,33 @@ class Options:
                                        epilog = repo_manager.generate_help())
         parser.add_option("-p", "--parallel", help = "run scm tasks in parallel",
                           action="store_true", default=False)
-        parser.add_option("-s", "--screen", help = "run scm tasks in screen",
+        parser.add_option("-j", "--jobs", help = "number of parallel scm tasks (default: number of CPUs)",
+                          type="int", default=os.cpu_count() or 1)
+        parser.add_option("--host-jobs", help = "number of parallel scm tasks per remote host (default: 4)",
+                          type="int", default=4)
+        parser.add_option("--no-multiplex", help = "don't share one ssh connection per remote host",
+                          action="store_false", dest="multiplex", default=True)
+        parser.add_option("--ordered", help = "report output of parallel scm tasks in selection order",
+                          action="store_true", default=False)
+        parser.add_option("--timeout", help = "kill scm tasks running longer than TIMEOUT seconds",
+                          type="float", default=None)
+        parser.add_option("--mirrors", help = "directory of the local mirrors (default: ~/.metagit-mirrors)",
+                          default=os.environ.get("METAGIT_MIRRORS", "~/.metagit-mirrors"))
+        parser.add_option("--reference", help = "clone: copy objects from the local mirror instead of downloading them",
+                          action="store_true", default=False)
+        parser.add_option("--from-mirror", help = "clone/fetch/pull: use the local mirror instead of the remote site",
+                          action="store_true", default=False)
+        parser.add_option("--changed", help = "fetch/pull: only repositories whose remote site changed",
+                          action="store_true", default=False)
+        parser.add_option("--fast", help = "status: only print a summary line per repository",
+                          action="store_true", default=False)
+        parser.add_option("--timings", help = "print the time spent in every phase of the run",
+                          action="store_true", default=False)
+        parser.add_option("--profile", help = "write the timings in trace event format to PROFILE",
+                          metavar = "PROFILE", default=None)
+        parser.add_option("-s", "--screen", help = "run scm tasks in screen windows (at most JOBS at once)",
+                          action="store_true", default=False)
+        parser.add_option("--tmux", help = "run scm tasks in tmux windows (at most JOBS at once)",
                           action="store_true", default=False)
 
 
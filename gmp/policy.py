@@ -1,5 +1,14 @@
 import re
-from socket import getfqdn
+
+_hostname = None
+def local_hostname():
+    """The fqdn of the local host. It is looked up on the first use,
+    since that may take a while"""
+    global _hostname
+    if _hostname is None:
+        from socket import getfqdn
+        _hostname = getfqdn()
+    return _hostname
 
 class PolicyMixin:
     def __init__(self, default_policy = "allow"):
@@ -13,10 +22,15 @@ be checked against the regexp here provided"""
 
         return self
 
-    def check_policy(self, hostname = getfqdn()):
+    def check_policy(self, hostname = None):
         """In order, that you can't clone your big pr0n git into
 your working directory you can define a policy for this repository, 
 that it is only visible on your local machine."""
+        if len(self.policies) == 1:
+            # Only the default policy, no need for the hostname
+            return self.policies[0][1] == "allow"
+        if hostname is None:
+            hostname = local_hostname()
         result = False
         for (regexp, policy) in self.policies:
             if re.match(".*" + regexp, hostname) != None:
@@ -34,3 +48,12 @@ that it is only visible on your local machine."""
                                            repr(policy))
         return ret
         
+
+    def policy_to_list(self):
+        """All policies added with add_policy as list of pairs"""
+        return [list(x) for x in self.policies[1:]]
+
+    def policy_from_list(self, policies):
+        for (regexp, policy) in policies:
+            self.add_policy(regexp, policy)
+        return self
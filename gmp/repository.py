@@ -1,5 +1,7 @@
 import os
 import re
+import stat
+import time
 from gmp.policy import PolicyMixin
 from gmp.tools import *
 from gmp.scm import *
@@ -8,16 +10,20 @@ class Repository (PolicyMixin):
     """A Repository instance represents exactly one repository"""
 
     homedir = os.path.expanduser("~/")
+    # Listings after this time were done by this run
+    started = time.time()
 
     def __init__(self, clone_url, local_url = None,
                  into = ".", default_policy = "allow",
-                 scm = Git(), read_only=False):
+                 scm = Git(), read_only=False, clone_args = []):
         """clone_url: the url which is used to clone the repository
 local_url: to this directory the repository is cloned
 into: if local_url is null, the repository is cloned into the <into> directory, and the
       repository name is appended (without the .git)
 default_policy: defines if the repo can be cloned on all machines ("allow") or not
-      ("deny"). See add_policy and check_policy for details"""
+      ("deny"). See add_policy and check_policy for details
+clone_args: additional arguments for the clone, e.g. ["--filter=blob:none"]
+      or ["--depth", "1"]. Give it to a repo lister to use it for a whole set"""
 
         PolicyMixin.__init__(self, default_policy)
 
@@ -46,65 +52,183 @@ default_policy: defines if the repo can be cloned on all machines ("allow") or n
         self.local_url = os.path.expanduser(self.local_url)
 
         self.read_only = read_only
+        self.clone_args = list(clone_args)
+
+        # Time of the last push to the remote site, as reported by the
+        # repo lister at listed_at (if the lister knows it)
+        self.pushed_at = None
+        self.listed_at = None
+        # The cache_ttl of the lister, while it is not expired the
+        # listing counts as up to date
+        self.listing_ttl = None
 
     def __str__(self):
         """A Repository can be serialized"""
-        ret = "%s(%s, %s, default_policy = %s, scm = %s, read_only=%s)" %(
+        ret = "%s(%s, %s, default_policy = %s, scm = %s, read_only=%s, clone_args = %s)" %(
             self.__class__.__name__,
             repr(self.clone_url),
             repr(self.local_url),
             repr(self.policies[0][1]),
             str(self.scm),
-            str(self.read_only))
+            str(self.read_only),
+            repr(self.clone_args))
 
         ret += self.policy_serialize()
 
         return ret
 
 
+    def to_dict(self):
+        """Serializes the repository into a dict of plain values, e.g.
+        for the RepoLister cache (see from_dict)"""
+        return {"clone_url": self.clone_url,
+                "local_url": self.local_url,
+                "default_policy": self.policies[0][1],
+                "policies": self.policy_to_list(),
+                "scm": self.scm.to_dict(),
+                "read_only": self.read_only,
+                "clone_args": self.clone_args,
+                "pushed_at": self.pushed_at}
+
+    def from_dict(data, scm = None):
+        """Creates a repository from the output of to_dict. An already
+        deserialized scm can be passed to share it between repositories"""
+        repo = Repository(data["clone_url"], data["local_url"],
+                          default_policy = data["default_policy"],
+                          scm = scm or SCM.from_dict(data["scm"]),
+                          read_only = data["read_only"],
+                          clone_args = data.get("clone_args", []))
+        repo.pushed_at = data.get("pushed_at")
+        return repo.policy_from_list(data["policies"])
+    from_dict = staticmethod(from_dict)
+
+    def short_local_url(self):
+        """The local url with the home directory replaced by ~/"""
+        local = self.local_url
+        if local.startswith(self.homedir):
+            local = "~/" + local[len(self.homedir):]
+        return local
+
+    def mirror_path(self, directory):
+        """Where the bare mirror of this repository is kept within
+        directory, e.g. github.com/user/project.git"""
+        url = re.sub("^[a-z+]+://", "", self.clone_url)
+        url = re.sub("^[^/@]*@", "", url)
+        url = url.replace(":", "/").strip("/")
+        if url.endswith("." + self.scm.binary):
+            url = url[:-len(self.scm.binary) - 1]
+        return os.path.join(os.path.expanduser(directory), url + ".git")
+
+    def local_mirror(self):
+        """The mirror of this repository in --mirrors or None, if there is none"""
+        if not self.scm.mirrors:
+            return None
+        path = self.mirror_path(Options.opt('mirrors'))
+        if os.path.isdir(path):
+            return path
+        return None
+
+    def listing_current(self):
+        """Was the repository listed by this run or is the cached listing
+        younger than the cache_ttl of its lister?"""
+        if self.listed_at is None:
+            return False
+        if self.listed_at >= Repository.started:
+            return True
+        return self.listing_ttl is not None and time.time() - self.listed_at <= self.listing_ttl
+
+    def pushed_since_fetch(self):
+        """Was the remote site pushed to since the last fetch? Answered
+        from pushed_at: True or False, None if that is unknown. An old
+        listing can't tell, that there was no push since the fetch"""
+        if self.pushed_at is None or self.listed_at is None:
+            return None
+        fetched = self.scm.fetched_at(self.local_url)
+        if fetched is None:
+            return None
+        if self.pushed_at > fetched:
+            return True
+        if fetched <= self.listed_at and self.listing_current():
+            # The lister saw no push after the fetch
+            return False
+        return None
+
     def status_line(self):
         sets = ":".join(self.set)
         if sets != "":
             sets = ":" + sets
 
-        local = self.local_url
-        if local.startswith(self.homedir):
-            local = "~/" + local[len(self.homedir):]
         return "%s (%s%s) %s --> %s" % (self.get_state(),
                                         self.scm.name, sets,
-                                        self.clone_url, local)
+                                        self.clone_url, self.short_local_url())
+
+    def __writable(mode, is_dir):
+        # ug+rwX
+        mode |= stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP
+        if is_dir or mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH):
+            mode |= stat.S_IXUSR | stat.S_IXGRP
+        return mode
+    __writable = staticmethod(__writable)
+
+    def __read_only(mode, is_dir):
+        # a-w
+        return mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+    __read_only = staticmethod(__read_only)
 
     def unlock(self):
         """Unlock repository, if it is read_only"""
         if os.path.exists(self.local_url) and self.read_only:
-            proc = execute([os.environ.get("CHMOD", "chmod"), "-R", "ug+rwX", self.local_url])
-            proc.wait() # We must wait for the readonly
+            with Timings.phase("unlock", repo = self.local_url):
+                chmod_tree(self.local_url, self.__writable)
 
     def lock(self):
         """Make repository readonly"""
         if self.read_only:
-            with open(os.path.join(self.local_url, 'README_READONLY.txt'), 'w+') as fd:
-                fd.write("Dies ist eine Read-Only Kopie des Repositories:\n\n  %s\n" %(self.clone_url))
+            readme = os.path.join(self.local_url, 'README_READONLY.txt')
+            if not os.path.exists(readme):
+                with open(readme, 'w+') as fd:
+                    fd.write("Dies ist eine Read-Only Kopie des Repositories:\n\n  %s\n" %(self.clone_url))
 
-            proc = execute([os.environ.get("CHMOD", "chmod"), "-R", "a-w", self.local_url])
-            proc.wait()
+            with Timings.phase("lock", repo = self.local_url):
+                chmod_tree(self.local_url, self.__read_only)
     #
     # Thin Wrappers for the underlying scm implementation
     #
     def get_state(self):
         return self.scm.get_state(self.local_url)
 
+    """Commands which use the local mirror with --from-mirror"""
+    mirrored_commands = ["clone", "fetch", "pull"]
+
     def execute(self, command, args = [], parallel = False, **kwargs):
         """Will use the self.<command> function if there is one, or
         otherwise use scm.execute to do it directly"""
+        if command in self.mirrored_commands:
+            self.__from_mirror(kwargs)
         if command in dir(self):
             ret = getattr(self, command)(command, args = args, **kwargs)
         else:
+            if command in self.scm.remote_commands:
+                kwargs.setdefault("remote", self.clone_url)
             ret = self.scm.execute(command, args = args, destdir = self.local_url, **kwargs)
 
         return ret
 
 
-    def clone(self, command, args):
-        """Clone must be special, because there is no destdir at this very moment"""
-        return self.scm.execute(command, args = args)
+    def __from_mirror(self, kwargs):
+        """With --from-mirror, the scm talks to the local mirror instead
+        of the remote site (if there is a mirror)"""
+        mirror = Options.opt('from_mirror') and self.local_mirror()
+        if mirror:
+            kwargs["scm_args"] = self.scm.mirror_args(mirror, self.clone_url)
+            kwargs["remote"] = None
+
+    def clone(self, command, args, **kwargs):
+        """Clone must be special, because there is no destdir at this very moment.
+        With --reference, objects are copied from the mirror of this
+        repository (if there is one)"""
+        args = list(args) + self.clone_args
+        mirror = Options.opt('reference') and self.local_mirror()
+        if mirror:
+            args += self.scm.reference_args(mirror)
+        return self.scm.execute(command, args = args, **kwargs)
@@ -0,0 +1,286 @@
+import os
+import sys
+import time
+import shlex
+import shutil
+import contextlib
+
+from gmp.options import *
+from gmp.ssh import *
+from gmp.timings import *
+
+# asyncio is imported by the functions which use it. It takes a good
+# part of the startup time and commands like list don't need it
+
+class Job:
+    """A Job is a single command which is started by the Scheduler as
+    soon as a slot is free. Commands given as a list are executed
+    directly, strings are passed to the shell. If capture is set,
+    stdout and stderr of the job are spooled to a temporary file and
+    reported as one block, after the job has finished. If show is
+    not set, the captured output is kept for read() instead"""
+
+    def __init__(self, cmd, echo = True, capture = False, timeout = None, cwd = None,
+                 show = True):
+        self.cmd = cmd
+        self.cwd = cwd
+        self.echo = echo
+        self.capture = capture
+        self.show = show
+        self.timeout = timeout
+        self.output = None
+        # The repository this job works on (set by the caller, if any)
+        self.repo = None
+        # Remote host and ssh destination of jobs which talk to a remote site
+        self.host = None
+        self.ssh = None
+        self.task = None
+        self.process = None
+        self.returncode = None
+        self.timed_out = False
+
+    async def run(self, env = None):
+        """Spawns the command and waits for it to terminate (or to time out)"""
+        import asyncio, tempfile
+        stdin = stdout = stderr = None
+        if self.capture:
+            self.output = stdout = tempfile.TemporaryFile()
+            stderr = asyncio.subprocess.STDOUT
+            stdin = asyncio.subprocess.DEVNULL
+        elif self.echo:
+            print(self.display())
+            sys.stdout.flush()
+
+        try:
+            if type(self.cmd) == str:
+                self.process = await asyncio.create_subprocess_shell(
+                    self.cmd, stdin = stdin, stdout = stdout, stderr = stderr,
+                    cwd = self.cwd, env = env)
+            else:
+                self.process = await asyncio.create_subprocess_exec(
+                    *self.cmd, stdin = stdin, stdout = stdout, stderr = stderr,
+                    cwd = self.cwd, env = env)
+        except OSError as e:
+            (self.output or sys.stderr.buffer).write(("%s: %s\n" % (self.display(), e.strerror)).encode())
+            self.returncode = 127
+            return self.returncode
+
+        try:
+            self.returncode = await asyncio.wait_for(self.process.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            self.timed_out = True
+            self.__signal(self.process.kill)
+            self.returncode = await self.process.wait()
+        except asyncio.CancelledError:
+            # Ctrl-C: give the scm a chance to clean up its lock files
+            self.__signal(self.process.terminate)
+            await self.process.wait()
+            raise
+        return self.returncode
+
+    def __signal(self, send):
+        try:
+            send()
+        except ProcessLookupError:
+            # Already terminated
+            pass
+
+    def display(self):
+        """The command as it would be typed into a shell"""
+        cmd = self.cmd
+        if type(cmd) != str:
+            cmd = shlex.join(cmd)
+        if self.cwd:
+            cmd = "cd %s; %s" % (shlex.quote(self.cwd), cmd)
+        return cmd
+
+    def name(self):
+        if self.repo:
+            return self.repo.local_url
+        return self.display()
+
+    def status(self):
+        if self.timed_out:
+            return "timeout after %ss" % self.timeout
+        return "exit %d" % self.returncode
+
+    def report(self):
+        """Writes the captured output with a header to stdout"""
+        if not self.capture or not self.show:
+            return
+        sys.stdout.write("==> %s (%s)\n" % (self.name(), self.status()))
+        if self.echo:
+            sys.stdout.write("%s\n" % self.display())
+        sys.stdout.flush()
+        self.output.seek(0)
+        shutil.copyfileobj(self.output, sys.stdout.buffer)
+        sys.stdout.buffer.flush()
+        self.output.close()
+        self.output = None
+
+    def read(self):
+        """Returns the captured output of a finished job"""
+        self.output.seek(0)
+        output = self.output.read().decode(errors = "replace")
+        self.output.close()
+        self.output = None
+        return output
+
+    def remote(self, url):
+        """Mark this job as one which talks to the remote site of url"""
+        self.host = remote_host(url)
+        self.ssh = ssh_destination(url)
+
+    def running(self):
+        return self.process is not None and self.returncode is None
+
+    def done(self):
+        return self.returncode is not None
+
+    def wait(self):
+        """Waits until this job is done. Other jobs are scheduled in the meantime"""
+        Scheduler.get().wait(self)
+        return self.returncode
+
+
+class Scheduler:
+    """The Scheduler runs all jobs from a single asyncio event loop,
+    with at most `jobs' processes at the same time (see --jobs) and at
+    most `host_jobs' processes per remote host (see --host-jobs). If
+    ordered is set, the captured output of the jobs is reported in the
+    order they were submitted (see --ordered)"""
+    instance = None
+
+    def __init__(self, jobs = None, host_jobs = None, ordered = False):
+        import asyncio
+        self.jobs = max(1, jobs or os.cpu_count() or 1)
+        self.host_jobs = max(1, host_jobs or self.jobs)
+        self.ordered = ordered
+        self.loop = asyncio.new_event_loop()
+        self.__watch_children()
+        self.slots = asyncio.Semaphore(self.jobs)
+        self.hosts = {}
+        self.unfinished = []
+        self.finished = []
+        # Finished, but not yet reported jobs (for ordered output)
+        self.submitted = 0
+        self.reported = 0
+        self.unreported = {}
+        # Follow-up stages of jobs (see then), they run in worker threads
+        self.stages = []
+        self.stage_pool = None
+
+    def get():
+        # In serial mode, every job is waited for right after it was
+        # submitted (see execute), so only one of them is running
+        if not Scheduler.instance:
+            Scheduler.instance = Scheduler(Options.opt('jobs'),
+                                           Options.opt('host_jobs'),
+                                           Options.opt('ordered'))
+        return Scheduler.instance
+    get = staticmethod(get)
+
+    def __watch_children(self):
+        """Before python 3.12 asyncio uses one thread per child process;
+        pidfds scale to thousands of children"""
+        import asyncio
+        if sys.version_info >= (3, 12) or not hasattr(asyncio, "PidfdChildWatcher"):
+            return
+        try:
+            os.close(os.pidfd_open(os.getpid()))
+        except (AttributeError, OSError):
+            return
+        watcher = asyncio.PidfdChildWatcher()
+        watcher.attach_loop(self.loop)
+        asyncio.set_child_watcher(watcher)
+
+    def submit(self, job):
+        """Queue a job; it is started as soon as a slot is free"""
+        job.sequence = self.submitted
+        self.submitted += 1
+        if job.timeout is None:
+            job.timeout = Options.opt('timeout')
+        job.task = self.loop.create_task(self.__run(job))
+        self.unfinished.append(job)
+        return job
+
+    def __host(self, host):
+        import asyncio
+        if not host:
+            return contextlib.nullcontext()
+        if not host in self.hosts:
+            self.hosts[host] = asyncio.Semaphore(self.host_jobs)
+        return self.hosts[host]
+
+    async def __run(self, job):
+        async with self.__host(job.host):
+            async with self.slots:
+                env = None
+                if job.ssh and Options.opt('multiplex'):
+                    env = await SSHMultiplexer.get().env(*job.ssh)
+                begin = time.perf_counter()
+                await job.run(env)
+                Timings.record("job", begin, time.perf_counter(),
+                               job = job.name(), exit = job.returncode)
+        self.unfinished.remove(job)
+        self.finished.append(job)
+        self.__report(job)
+
+    def __report(self, job):
+        if not self.ordered:
+            job.report()
+            return
+        self.unreported[job.sequence] = job
+        while self.reported in self.unreported:
+            self.unreported.pop(self.reported).report()
+            self.reported += 1
+
+    def then(self, jobs, function):
+        """Calls function(jobs) in a worker thread, as soon as all jobs
+        are done. This way a follow-up stage (e.g. locking a fresh
+        clone) overlaps with the jobs still running. At most `jobs'
+        stages run at the same time"""
+        import concurrent.futures
+        if not self.stage_pool:
+            self.stage_pool = concurrent.futures.ThreadPoolExecutor(self.jobs)
+        tasks = [job.task for job in jobs if job.task]
+        self.stages.append(self.loop.create_task(self.__stage(tasks, jobs, function)))
+
+    async def __stage(self, tasks, jobs, function):
+        import asyncio
+        if tasks:
+            await asyncio.gather(*tasks)
+        await self.loop.run_in_executor(self.stage_pool, function, jobs)
+
+    def __drive(self, future):
+        """Runs the event loop until future is done. On Ctrl-C all
+        running jobs are terminated and metagit exits"""
+        import asyncio
+        future = asyncio.ensure_future(future, loop = self.loop)
+        try:
+            self.loop.run_until_complete(future)
+        except KeyboardInterrupt:
+            cancelled = len(self.unfinished)
+            tasks = [job.task for job in self.unfinished] + self.stages
+            for task in tasks + [future]:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, future,
+                                                        return_exceptions = True))
+            sys.stderr.write("\nInterrupted, %d jobs cancelled\n" % cancelled)
+            sys.exit(130)
+
+    def wait(self, job):
+        """Schedule jobs until `job' is done"""
+        if not job.done():
+            self.__drive(job.task)
+
+    def run(self):
+        """Schedule jobs until the queue is empty and all jobs (and their
+        stages) are done. Returns the list of jobs finished during this run"""
+        import asyncio
+        first = len(self.finished)
+        tasks = [job.task for job in self.unfinished] + self.stages
+        self.stages = []
+        if tasks:
+            self.__drive(asyncio.gather(*tasks))
+        return self.finished[first:]
@@ -1,9 +1,60 @@
 import subprocess
+import shlex
 import re
 import os
 
 from .tools import *
 
+class StateCache:
+    """Caches the states of local repositories (see SCM.get_state) for
+    one run, since they are needed several times during a command"""
+    states = {}
+
+    def lookup(local_url, metadata_dir):
+        return StateCache.states.get((local_url, metadata_dir))
+    lookup = staticmethod(lookup)
+
+    def store(local_url, metadata_dir, state):
+        StateCache.states[(local_url, metadata_dir)] = state
+    store = staticmethod(store)
+
+    def invalidate(local_url = None):
+        """Forget the state of local_url (or of all repositories)"""
+        if local_url is None:
+            StateCache.states = {}
+            return
+        for key in [key for key in StateCache.states if key[0] == local_url]:
+            del StateCache.states[key]
+    invalidate = staticmethod(invalidate)
+
+    def prime(repos):
+        """Determines the states of all repositories in one sweep: each
+        parent directory is listed only once, and only directories found
+        there are probed further"""
+        parents = {}
+        for repo in repos:
+            if StateCache.lookup(repo.local_url, repo.scm.metadata_dir) is None:
+                parent = os.path.dirname(repo.local_url) or "."
+                parents.setdefault(parent, []).append(repo)
+
+        for parent, repos in parents.items():
+            try:
+                with os.scandir(parent) as it:
+                    entries = {entry.name: entry.is_dir() for entry in it}
+            except OSError:
+                entries = {}
+            for repo in repos:
+                name = os.path.basename(repo.local_url)
+                if not name in entries:
+                    state = repo.scm.STATE_NOT_EXISTS
+                elif not entries[name]:
+                    state = repo.scm.STATE_NO_REPO
+                else:
+                    state = repo.scm.probe_state(repo.local_url, exists = True)
+                StateCache.store(repo.local_url, repo.scm.metadata_dir, state)
+    prime = staticmethod(prime)
+
+
 class SCM:
     """SCM is the abstract base class which implements defines the
     interface a scm must implement to be used by the Repository
@@ -19,6 +70,16 @@ class SCM:
     clone command will be replaced by svn clone"""
     aliases = {}
 
+    """Commands which talk to the remote site of a repository"""
+    remote_commands = ["clone", "fetch", "pull", "push"]
+
+    """Commands which don't change the repository, read_only
+    repositories aren't unlocked for them"""
+    read_only_commands = ["status", "diff", "log", "show", "blame", "grep", "ls-files"]
+
+    """Can bare mirrors of the repositories be kept (see metagit mirror)?"""
+    mirrors = False
+
     STATE_EXISTS = '+'
     STATE_BARE = 'b'
     STATE_NOT_EXISTS = '-'
@@ -53,8 +114,10 @@ class SCM:
     def __option(self, command):
         """Get all add_option() for a specific command. (See add_option)"""
         if not command in self.options:
-            return ""
-        return " ".join(self.options[command])
+            return []
+        # An option may consist of several words, e.g. "-c foo=bar"
+        return [word for option in self.options[command]
+                for word in shlex.split(option)]
 
     #
     # Aliases
@@ -66,18 +129,17 @@ class SCM:
     def __alias(self, command):
         """Lookup the command in the self.aliases and replace it if neccessary"""
         if command in self.aliases:
-            return self.aliases[command]
-        return command
+            return self.aliases[command].split()
+        return [command]
 
     #
     # Helper functions for executing things
     #
-    def __exec_string(self, command, args = []):
-        """Produces an shell command for <command> + <args>"""
-        # Escape all ' characters
-        args = [esc(x) for x in args]
-        return " ".join([self.binary, self.__alias(command),
-                         self.__option(command)] + args)
+    def __exec_args(self, command, args = [], scm_args = []):
+        """Produces the argument list for <command> + <args>"""
+        return [self.binary] + list(scm_args) + self.__alias(command) \
+            + self.__option(command) + list(args)
+
     def execute(self, command, args = [], destdir = None, **kwargs):
         """Will use the self.<command> function if there is one, or
         otherwise use __execute to do it directly"""
@@ -86,20 +148,14 @@ class SCM:
 
         return self.bare_execute(command, args, destdir, **kwargs)
 
-    def bare_execute(self, command, args = [], destdir = None, echo = True):
-        """Prints the command to stdout and executes it within a shell
-        context. Everything will be fine escaped"""
-        command = self.__exec_string(command, args)
-        parallel = Options.opt("parallel")
+    def bare_execute(self, command, args = [], destdir = None, echo = True, remote = None,
+                     scm_args = []):
+        """Prints the command to stdout and executes it (without a
+        shell) within destdir. remote is the url of the remote site, if
+        the command talks to it. scm_args are given before the command"""
+        command = self.__exec_args(command, args, scm_args)
 
-        # Maybe we have to change the directory first
-        if destdir:
-            command = "cd %s; %s" %(esc(destdir), command)
-
-        if parallel:
-            command += " >/dev/null"
-
-        a = execute(command, echo = echo)
+        a = execute(command, echo = echo, remote = remote, cwd = destdir)
 
         return [a]
 
@@ -107,7 +163,9 @@ class SCM:
     # All subclasses must be serializable
     #
     def __str__(self):
-        ret = self.__class__.__name__ + self.__str_keyword_arguments__()
+        ret = self.__class__.__name__ + "(%s)" % ", ".join(
+            ["%s = %s" % (key, repr(value))
+             for key, value in self.keyword_arguments().items()])
 
         for cmd in list(self.options.keys()):
             for option in self.options[cmd]:
@@ -115,41 +173,231 @@ class SCM:
                                                repr(option))
         return ret
 
-    def __str_keyword_arguments__(self):
-        """For serializing a scm we also need to print all keyword arguments"""
-        return "()"
+    def keyword_arguments(self):
+        """For serializing a scm we also need all keyword arguments"""
+        return {}
+
+    def to_dict(self):
+        """Serializes the scm into a dict of plain values (see from_dict)"""
+        return {"class": self.__class__.__name__,
+                "kwargs": self.keyword_arguments(),
+                "options": self.options}
+
+    def from_dict(data):
+        """Creates a scm from the output of to_dict"""
+        classes = [SCM]
+        while classes:
+            cls = classes.pop()
+            if cls.__name__ == data["class"]:
+                scm = cls(**data["kwargs"])
+                for command, options in data["options"].items():
+                    scm.add_option(command, options)
+                return scm
+            classes.extend(cls.__subclasses__())
+        raise ValueError("Unknown scm: " + data["class"])
+    from_dict = staticmethod(from_dict)
 
     def get_state(self, local_url):
         """'+' if the repository exists
+           'b' if the destination is a bare repository
            'N' if the destination directory exists but isn't a git repo
-           '-' if the destination doesn't exists"""
+           '-' if the destination doesn't exists
+        The result is cached for the rest of the run (see StateCache)"""
+        state = StateCache.lookup(local_url, self.metadata_dir)
+        if state is None:
+            state = self.probe_state(local_url)
+            StateCache.store(local_url, self.metadata_dir, state)
+        return state
+
+    def probe_state(self, local_url, exists = None):
+        """Determines the state of local_url on the filesystem (see
+        get_state). exists can be given, if it is already known"""
+        if exists is False:
+            return self.STATE_NOT_EXISTS
         if os.path.exists(os.path.join(local_url, self.metadata_dir)):
             return self.STATE_EXISTS
         elif os.path.exists(os.path.join(local_url, "refs")):
             return self.STATE_BARE
-        elif os.path.exists(local_url):
+        elif exists or os.path.exists(local_url):
             return self.STATE_NO_REPO
         else:
             return self.STATE_NOT_EXISTS
 
 
+    #
+    # Machine readable status of a working copy (see status --fast)
+    #
+    def status_command(self):
+        """Returns the argument list for a machine readable status or
+        None, if the scm doesn't provide one (see parse_status)"""
+        return None
+
+    def parse_status(self, output):
+        """Parses the output of status_command into a dict with the
+        keys branch, ahead, behind and changes"""
+        return {}
+
+    def head(self, local_url):
+        """Returns the current branch of the repository"""
+        return None
+
+    #
+    # Comparing with the remote site (see fetch --changed)
+    #
+    def fetched_at(self, local_url):
+        """Time of the last fetch from the remote site, None if unknown"""
+        return None
+
+    def remote_refs_command(self, url):
+        """Returns the argument list, which lists the refs of the remote
+        site at url or None, if the scm can't do it (see parse_remote_refs)"""
+        return None
+
+    def parse_remote_refs(self, output):
+        """Parses the output of remote_refs_command into a dict of ref -> id"""
+        return {}
+
+    def remote_changed(self, local_url, remote_refs):
+        """Do the refs of the remote site differ from the local ones?"""
+        return True
+
+    def reference_args(self, mirror):
+        """Arguments for clone to borrow the objects from the local
+        mirror instead of downloading them"""
+        return []
+
+    def mirror_args(self, mirror, url):
+        """Arguments for the scm (before the command), which redirect
+        clone and fetch from url to the local mirror"""
+        return []
+
     #
     # Wrapper functions for scm commands, can be overriden by
     # subclassing. These functions will overide the normal execution function
     #
-    def clone(self, args = [], destdir = None):
+    def clone(self, args = [], destdir = None, **kwargs):
         """Calling this method will clone the remote_repo
         to the local url. This method will execute the command"""
 
-        [remote_repo, local_repo] = args
-        return self.bare_execute("clone", [remote_repo, local_repo])
+        kwargs.setdefault("remote", args[0])
+        return self.bare_execute("clone", args, **kwargs)
 
 class Git(SCM):
     name = "git"
     binary = "git"
+    mirrors = True
     def __init__(self):
         SCM.__init__(self)
 
+    def status_command(self):
+        # Wrappers like eg and git svn all work on plain git repositories
+        return ["git", "status", "--porcelain=v2", "--branch"]
+
+    def parse_status(self, output):
+        status = {"branch": None, "ahead": 0, "behind": 0, "changes": 0}
+        for line in output.splitlines():
+            if line.startswith("# branch.head "):
+                status["branch"] = line[len("# branch.head "):]
+            elif line.startswith("# branch.ab "):
+                ahead, behind = line[len("# branch.ab "):].split()
+                status["ahead"] = int(ahead)
+                status["behind"] = -int(behind)
+            elif line[:1] in ("1", "2", "u", "?"):
+                status["changes"] += 1
+        return status
+
+    def reference_args(self, mirror):
+        # The objects are copied from the mirror, not downloaded. Without
+        # --dissociate the clone would keep using them (alternates) and
+        # break, when metagit mirror prunes them (see git-clone(1))
+        return ["--reference-if-able", mirror, "--dissociate"]
+
+    def mirror_args(self, mirror, url):
+        # The url is only rewritten for the transport, the
+        # configured remote stays the same
+        return ["-c", "url.%s.insteadOf=%s" % (mirror, url)]
+
+    def __gitdir(self, local_url):
+        gitdir = os.path.join(local_url, self.metadata_dir)
+        if os.path.isfile(gitdir):
+            # Worktrees and submodules: .git is a "gitdir: <path>" file
+            with open(gitdir) as fd:
+                gitdir = os.path.join(local_url, fd.read().strip()[len("gitdir: "):])
+        elif not os.path.isdir(gitdir):
+            # Bare repository
+            gitdir = local_url
+        return gitdir
+
+    def head(self, local_url):
+        """Reads the current branch directly from HEAD, without
+        starting git"""
+        gitdir = self.__gitdir(local_url)
+        try:
+            with open(os.path.join(gitdir, "HEAD")) as fd:
+                head = fd.read().strip()
+        except OSError:
+            return None
+        if head.startswith("ref: refs/heads/"):
+            return head[len("ref: refs/heads/"):]
+        return "(detached)"
+
+    def fetched_at(self, local_url):
+        # FETCH_HEAD is rewritten by every fetch and pull
+        try:
+            return os.stat(os.path.join(self.__gitdir(local_url), "FETCH_HEAD")).st_mtime
+        except OSError:
+            return None
+
+    def remote_refs_command(self, url):
+        return ["git", "ls-remote", "--heads", "--tags", url]
+
+    def parse_remote_refs(self, output):
+        refs = {}
+        for line in output.splitlines():
+            sha, _, ref = line.partition("\t")
+            # Skip peeled tags
+            if ref and not ref.endswith("^{}"):
+                refs[ref] = sha
+        return refs
+
+    def local_refs(self, local_url, prefixes = ("refs/remotes/origin/", "refs/tags/")):
+        """Reads the refs below prefixes directly from the repository
+        (packed-refs and loose refs), without starting git"""
+        gitdir = self.__gitdir(local_url)
+        refs = {}
+        try:
+            with open(os.path.join(gitdir, "packed-refs")) as fd:
+                for line in fd:
+                    sha, _, ref = line.strip().partition(" ")
+                    if ref.startswith(prefixes):
+                        refs[ref] = sha
+        except OSError:
+            pass
+        # Loose refs take precedence over packed ones
+        for prefix in prefixes:
+            top = os.path.join(gitdir, prefix)
+            for directory, _, files in os.walk(top):
+                for name in files:
+                    path = os.path.join(directory, name)
+                    ref = prefix + os.path.relpath(path, top).replace(os.sep, "/")
+                    try:
+                        with open(path) as fd:
+                            refs[ref] = fd.read().strip()
+                    except OSError:
+                        pass
+        return refs
+
+    def remote_changed(self, local_url, remote_refs):
+        """The remote site changed, if one of its branches or tags
+        differs from the local copy"""
+        local = self.local_refs(local_url)
+        for ref, sha in remote_refs.items():
+            if ref.startswith("refs/heads/"):
+                ref = "refs/remotes/origin/" + ref[len("refs/heads/"):]
+            if local.get(ref) != sha:
+                return True
+        return False
+
 git = Git()
 
 
@@ -171,6 +419,7 @@ class GitSvn(Git):
                "pull": "svn rebase"}
 
     name = "git-svn"
+    mirrors = False
 
     def __init__(self, externals = [], headonly = False, limit = None):
         Git.__init__(self)
@@ -178,17 +427,22 @@ class GitSvn(Git):
         self.headonly = headonly
         self.limit = limit
 
-    def __str_keyword_arguments__(self):
-        return "(externals = %s, headonly = %s, limit = %s)" % \
-               (repr(self.externals), repr(self.headonly), repr(self.limit))
+    def keyword_arguments(self):
+        return {"externals": self.externals,
+                "headonly": self.headonly,
+                "limit": self.limit}
+
+    def reference_args(self, mirror):
+        # git svn clone has no --reference
+        return []
 
     def __externals(self, destdir):
-        process = subprocess.Popen("cd %s; git svn propget svn:externals" % esc(destdir),
-                                   shell = True,
+        process = subprocess.Popen(["git", "svn", "propget", "svn:externals"],
+                                   cwd = destdir,
                                    stdout = subprocess.PIPE)
+        externals = [ re.split("\\s+", x.decode().strip()) for x in process.stdout.readlines()
+                      if x.strip() ]
         process.wait()
-        externals = [ re.split("\\s+", x.strip()) for x in process.stdout.readlines()
-                      if x != "\n" ]
 
 
         return externals
@@ -221,7 +475,10 @@ class GitSvn(Git):
         destdir = args[1]
         procs = []
         # Call the actual git svn clone (with aliases!)
-        procs.extend(self.bare_execute("clone", args = args + opts))
+        procs.extend(self.bare_execute("clone", args = args + opts, remote = args[0]))
+        for p in procs:
+            if p:
+                p.wait()
 
         fd = open(os.path.join(destdir, ".git/info/exclude"), "a+")
         fd.write("\n# Metagit svn external excludes\n")
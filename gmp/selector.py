@@ -0,0 +1,108 @@
+import os
+import re
+
+from gmp.scm import SCM
+
+class Selector:
+    """A selector is compiled once into a predicate on repositories.
+
+    Terms:
+      all            every repository
+      +, b, -, N     repositories in this state
+      set:<name>     repositories in the set <name>
+      scm:<name>     repositories managed by the scm <name> (git, hg, ...)
+      url:<regexp>   regexp is searched in the clone url
+      path:<regexp>  regexp is searched in the local url
+      <regexp>       regexp is searched in the output of metagit list
+
+    Terms can be negated with a leading `!' and combined with ` & '
+    and ` | ' (surrounded by spaces; & binds stronger)"""
+
+    fields = ["set", "scm", "url", "path", "state"]
+
+    def __init__(self, text):
+        self.text = text
+        # The predicate decides for repositories, the lister filter
+        # whether a repo lister in a set may produce matching ones
+        self.predicate, self.lister_filter = self.__or(text)
+
+    def __call__(self, repo):
+        return self.predicate(repo)
+
+    def may_match(self, set_name, lister):
+        """Can lister in the set set_name produce matching repositories?
+        Listers for which this is False are never listed"""
+        return self.lister_filter(set_name, lister)
+
+    def __or(self, text):
+        terms = [self.__and(x) for x in re.split("\\s+\\|\\s+", text)]
+        if len(terms) == 1:
+            return terms[0]
+        return (lambda repo: any(term(repo) for term, _ in terms),
+                lambda set_name, lister: any(may(set_name, lister) for _, may in terms))
+
+    def __and(self, text):
+        terms = [self.__term(x.strip()) for x in re.split("\\s+&\\s+", text)]
+        if len(terms) == 1:
+            return terms[0]
+        return (lambda repo: all(term(repo) for term, _ in terms),
+                lambda set_name, lister: all(may(set_name, lister) for _, may in terms))
+
+    def __term(self, text):
+        anything = lambda set_name, lister: True
+
+        if text.startswith("!") and len(text) > 1:
+            term, _ = self.__term(text[1:])
+            return (lambda repo: not term(repo), anything)
+
+        if text == "all":
+            return (lambda repo: True, anything)
+        if text in SCM.states:
+            return (lambda repo: repo.get_state() == text, anything)
+
+        m = re.match("^(%s):(.*)$" % "|".join(self.fields), text)
+        if not m:
+            regexp = re.compile(text, re.IGNORECASE)
+            return (lambda repo: regexp.search(repo.status_line()) is not None, anything)
+
+        field, value = m.groups()
+        if field == "set":
+            value = value.lower()
+            return (lambda repo: any(s.lower() == value for s in repo.set),
+                    lambda set_name, lister: set_name.lower() == value)
+        if field == "scm":
+            value = value.lower()
+            return (lambda repo: repo.scm.name.lower() == value,
+                    lambda set_name, lister: lister.scm.name.lower() == value)
+        if field == "state":
+            return (lambda repo: repo.get_state() == value, anything)
+        if field == "url":
+            regexp = re.compile(value, re.IGNORECASE)
+            return (lambda repo: regexp.search(repo.clone_url) is not None,
+                    self.__prefix_filter(value, lambda lister: lister.url_prefix()))
+        # path: ~/ is allowed in the regexp
+        if value.startswith("^"):
+            value = "^" + os.path.expanduser(value[1:])
+        else:
+            value = os.path.expanduser(value)
+        regexp = re.compile(value, re.IGNORECASE)
+        return (lambda repo: regexp.search(repo.local_url) is not None,
+                self.__prefix_filter(value, lambda lister: lister.path_prefix()))
+
+    def __prefix_filter(self, value, prefix_of):
+        """For regexps anchored with ^ the literal beginning must be
+        compatible with the prefix of all urls/paths of a lister"""
+        m = re.match("^\\^([^.^$*+?{}\\[\\]\\\\|()]*)", value)
+        if not m or not m.group(1):
+            return lambda set_name, lister: True
+        literal = m.group(1).lower()
+        if value[m.end():m.end() + 1] in ("?", "*", "{"):
+            # The quantifier makes the last character optional
+            literal = literal[:-1]
+        def may_match(set_name, lister):
+            prefix = prefix_of(lister)
+            if prefix is None:
+                return True
+            prefix = prefix.lower()
+            return prefix.startswith(literal) or literal.startswith(prefix)
+        return may_match
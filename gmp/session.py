@@ -0,0 +1,164 @@
+import os
+import sys
+import shlex
+import shutil
+import atexit
+import tempfile
+import threading
+import subprocess
+
+from gmp.options import *
+from gmp.scheduler import *
+
+class Session:
+    """A screen or tmux session (see --screen and --tmux), in which
+    every job gets its own window. Windows are opened by the Scheduler,
+    so at most --jobs commands run at the same time; the next window is
+    opened as soon as an earlier command has finished. The terminal is
+    attached to the session while the jobs are running"""
+    instance = None
+
+    def __init__(self, multiplexer):
+        self.multiplexer = multiplexer
+        self.name = "metagit-%d" % os.getpid()
+        # The exit codes of the windows are written to this directory
+        self.directory = tempfile.mkdtemp(prefix = "metagit-session-")
+        self.windows = 0
+        self.exits = 0
+        self.lock = None
+        self.attached = None
+        atexit.register(shutil.rmtree, self.directory, ignore_errors = True)
+
+    def get():
+        """Returns the session or None, if no session mode is selected"""
+        if not Session.instance:
+            if Options.opt('tmux'):
+                Session.instance = Session("tmux")
+            elif Options.opt('screen'):
+                Session.instance = Session("screen")
+        return Session.instance
+    get = staticmethod(get)
+
+    async def __call(self, argv, retries = 1):
+        import asyncio
+        for retry in range(retries):
+            process = await asyncio.create_subprocess_exec(*argv, stdin = asyncio.subprocess.DEVNULL)
+            if await process.wait() == 0:
+                return True
+            # A new screen session needs a moment, until it accepts commands
+            await asyncio.sleep(0.1)
+        return False
+
+    async def open(self, title, command):
+        """Opens a new window, in which the shell command runs"""
+        import asyncio
+        if not self.lock:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            first = self.windows == 0
+            self.windows += 1
+            if self.multiplexer == "tmux":
+                if first:
+                    argv = ["tmux", "new-session", "-d", "-s", self.name, "-n", title, command]
+                else:
+                    argv = ["tmux", "new-window", "-d", "-t", self.name + ":", "-n", title, command]
+                started = await self.__call(argv)
+            else:
+                if first:
+                    started = await self.__call(["screen", "-dmS", self.name, "-t", title,
+                                                 "sh", "-c", command])
+                    await self.__call(["screen", "-S", self.name, "-X", "caption", "always",
+                                       "%{wR}%c | %?%-Lw%?%{wB}%n*%f %t%?(%u)%?%{wR}%?%+Lw%?"],
+                                      retries = 10)
+                else:
+                    started = await self.__call(["screen", "-S", self.name, "-X", "screen",
+                                                 "-t", title, "sh", "-c", command], retries = 10)
+            if first and started:
+                self.__attach()
+            return started
+
+    def __attach(self):
+        """Attaches the terminal to the session in the background, the
+        scheduler keeps opening windows meanwhile"""
+        if not sys.stdin.isatty() or not sys.stdout.isatty():
+            return
+        if self.multiplexer == "tmux":
+            argv = ["tmux", "switch-client" if "TMUX" in os.environ else "attach-session",
+                    "-t", self.name]
+        else:
+            argv = ["screen", "-r", self.name]
+        self.attached = threading.Thread(target = subprocess.call, args = (argv,))
+        self.attached.start()
+
+    def exit_file(self):
+        """A new file name for the exit code of a window"""
+        self.exits += 1
+        return os.path.join(self.directory, "%d.exit" % self.exits)
+
+    def execute():
+        """Waits until the terminal was detached from the session (after
+        all jobs are done)"""
+        session = Session.instance
+        if not session:
+            return
+        if session.attached:
+            session.attached.join()
+            session.attached = None
+        if session.windows and session.alive():
+            attach = {"tmux": "tmux attach-session -t", "screen": "screen -r"}[session.multiplexer]
+            print("The session is still open: %s %s" % (attach, session.name))
+    execute = staticmethod(execute)
+
+    def alive(self):
+        if self.multiplexer == "tmux":
+            argv = ["tmux", "has-session", "-t", self.name]
+        else:
+            argv = ["screen", "-S", self.name, "-X", "select", "."]
+        return subprocess.call(argv, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL) == 0
+
+
+class SessionJob(Job):
+    """A job, which runs in a window of the Session. The window stays
+    open after the command finished, until ENTER is pressed; the exit
+    code is handed back through a file. There is no timeout for
+    interactive jobs"""
+
+    # Seconds between two looks for the exit code
+    poll_interval = 0.2
+    # Polls between two checks, whether the session was closed
+    alive_interval = 25
+
+    def __init__(self, cmd, session, **kwargs):
+        Job.__init__(self, cmd, **kwargs)
+        self.session = session
+
+    async def run(self, env = None):
+        import asyncio
+        exit_file = self.session.exit_file()
+        display = self.display()
+        # Windows don't inherit our environment (e.g. for ssh multiplexing)
+        exports = ""
+        if env and "GIT_SSH_COMMAND" in env:
+            exports = "GIT_SSH_COMMAND=%s; export GIT_SSH_COMMAND; " % shlex.quote(env["GIT_SSH_COMMAND"])
+        command = "%secho %s; %s; echo $? > %s.tmp; mv %s.tmp %s; echo Press ENTER; read a" % (
+            exports, shlex.quote(display), display,
+            shlex.quote(exit_file), shlex.quote(exit_file), shlex.quote(exit_file))
+
+        title = os.path.basename(self.repo.local_url if self.repo else (self.cwd or "")) \
+            or display.split()[0]
+        if not await self.session.open(title, command):
+            self.returncode = 127
+            return self.returncode
+
+        polls = 0
+        while not os.path.exists(exit_file):
+            await asyncio.sleep(self.poll_interval)
+            polls += 1
+            if polls % self.alive_interval == 0 and not self.session.alive() \
+               and not os.path.exists(exit_file):
+                # The session was closed before the command finished
+                self.returncode = 255
+                return self.returncode
+        with open(exit_file) as fd:
+            self.returncode = int(fd.read().strip() or 127)
+        return self.returncode
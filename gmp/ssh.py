@@ -0,0 +1,121 @@
+import os
+import re
+import time
+import glob
+import shlex
+import shutil
+import atexit
+import tempfile
+import subprocess
+
+def ssh_destination(url):
+    """Returns ([user@]host, port) for ssh clone urls and None for
+    everything else (local paths, http, git://)"""
+    m = re.match("^(?:git\\+)?ssh://([^/:]+)(?::(\\d+))?/", url)
+    if m:
+        return (m.group(1), m.group(2))
+    # scp like syntax: [user@]host:path, the path must not start a url scheme
+    m = re.match("^([^/:]+):(?!//)", url)
+    if m:
+        return (m.group(1), None)
+    return None
+
+def remote_host(url):
+    """Returns the host of a clone url, which is used to group jobs
+    (None for local repositories)"""
+    ssh = ssh_destination(url)
+    if ssh:
+        return ssh[0].split("@")[-1]
+    m = re.match("^[a-z+]+://(?:[^@/]*@)?([^/:]+)", url)
+    if m and not url.startswith("file:"):
+        return m.group(1)
+    return None
+
+
+class SSHMultiplexer:
+    """Opens one ssh ControlMaster per remote host, which is shared by all
+    scm processes talking to that host during a run"""
+    instance = None
+
+    # Seconds a master stays open after its last connection. They are
+    # closed at exit, this is for a metagit, which was killed
+    control_persist = 60
+
+    def __init__(self):
+        self.directory = None
+        self.masters = {}
+        atexit.register(self.close)
+
+    def get():
+        if not SSHMultiplexer.instance:
+            SSHMultiplexer.instance = SSHMultiplexer()
+        return SSHMultiplexer.instance
+    get = staticmethod(get)
+
+    def __options(self):
+        if not self.directory:
+            self.__remove_stale()
+            self.directory = tempfile.mkdtemp(prefix = "metagit-ssh-")
+        return ["-o", "ControlPath=" + os.path.join(self.directory, "%C")]
+
+    def __args(self, destination, port):
+        args = self.__options()
+        if port:
+            args += ["-p", port]
+        return args + [destination]
+
+    def __remove_stale(self):
+        """Removes the empty control directories of killed metagit runs,
+        whose masters have expired"""
+        for directory in glob.glob(os.path.join(tempfile.gettempdir(), "metagit-ssh-*")):
+            try:
+                info = os.lstat(directory)
+                if info.st_uid == os.getuid() \
+                   and time.time() - info.st_mtime > self.control_persist:
+                    # Fails, while there are still sockets in it
+                    os.rmdir(directory)
+            except OSError:
+                pass
+
+    async def env(self, destination, port = None):
+        """Returns an environment for a child process, which lets
+        git reuse the master connection to destination"""
+        import asyncio
+        env = dict(os.environ)
+        # Don't override the users choice
+        if "GIT_SSH" in env or "GIT_SSH_COMMAND" in env:
+            return env
+
+        if (destination, port) not in self.masters:
+            # Establish the master once, before any job uses it. If
+            # that fails, every job simply opens its own connection
+            self.masters[(destination, port)] = asyncio.ensure_future(self.__start(destination, port))
+        await asyncio.shield(self.masters[(destination, port)])
+
+        env["GIT_SSH_COMMAND"] = "ssh -o ControlMaster=no " \
+            + " ".join([shlex.quote(x) for x in self.__options()])
+        return env
+
+    async def __start(self, destination, port):
+        """Starts the master without blocking the other jobs"""
+        import asyncio
+        cmd = ["ssh", "-o", "ControlMaster=yes",
+               "-o", "ControlPersist=%d" % self.control_persist, "-fN"] \
+              + self.__args(destination, port)
+        try:
+            process = await asyncio.create_subprocess_exec(*cmd)
+        except OSError:
+            return False
+        return await process.wait() == 0
+
+    def close(self):
+        """Stop all master connections"""
+        for (destination, port), started in self.masters.items():
+            if started.done() and not started.cancelled() and not started.exception() \
+               and started.result():
+                subprocess.call(["ssh", "-O", "exit"] + self.__args(destination, port),
+                                stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+        self.masters = {}
+        if self.directory:
+            shutil.rmtree(self.directory, ignore_errors = True)
+            self.directory = None
@@ -0,0 +1,95 @@
+import os
+import sys
+import time
+import threading
+
+class Timings:
+    """Records the wall time of the phases of a metagit run (config
+    import, listing, selection, locking, every job). Recording is cheap
+    and always done; the records are only reported with --timings (a
+    summary on stderr) or --profile <file> (trace event format, which
+    can be loaded into chrome://tracing or https://ui.perfetto.dev)"""
+
+    # All times are relative to the start of metagit
+    start = time.perf_counter()
+    records = []
+    lock = threading.Lock()
+
+    def record(name, begin, end, **args):
+        """Records a phase, begin and end are time.perf_counter() values"""
+        with Timings.lock:
+            Timings.records.append((name, begin, end, threading.get_ident(), args))
+    record = staticmethod(record)
+
+    def phase(name, **args):
+        """Context manager, which records the time spent in the block"""
+        return Timings.__Phase(name, args)
+    phase = staticmethod(phase)
+
+    class __Phase:
+        def __init__(self, name, args):
+            self.name = name
+            self.args = args
+
+        def __enter__(self):
+            self.begin = time.perf_counter()
+            return self
+
+        def __exit__(self, *exc):
+            Timings.record(self.name, self.begin, time.perf_counter(), **self.args)
+            return False
+
+    def summary(out = sys.stderr, jobs = 10):
+        """Writes the total time per phase (longest first) and the
+        slowest jobs with their exit codes"""
+        phases = {}
+        job_records = []
+        for name, begin, end, tid, args in Timings.records:
+            if name == "job":
+                job_records.append((end - begin, args))
+                continue
+            count, total, longest = phases.get(name, (0, 0, 0))
+            phases[name] = (count + 1, total + end - begin, max(longest, end - begin))
+
+        out.write("%-32s %6s %10s %10s\n" % ("phase", "count", "total", "max"))
+        for name, (count, total, longest) in sorted(phases.items(), key = lambda x: -x[1][1]):
+            out.write("%-32s %6d %9.3fs %9.3fs\n" % (name, count, total, longest))
+        if job_records:
+            job_records.sort(key = lambda x: -x[0])
+            failed = len([1 for _, args in job_records if args.get("exit") != 0])
+            out.write("\n%d jobs (%d failed), %.3fs in total; the slowest:\n"
+                      % (len(job_records), failed, sum([x[0] for x in job_records])))
+            for duration, args in job_records[:jobs]:
+                out.write("  %9.3fs  [%s] %s\n" % (duration, args.get("exit"), args.get("job")))
+    summary = staticmethod(summary)
+
+    def trace_events():
+        """The records in the trace event format. Jobs run in the same
+        thread, but overlap; they get one lane per concurrently running job"""
+        events = []
+        lanes = []
+        pid = os.getpid()
+        for name, begin, end, tid, args in sorted(Timings.records, key = lambda x: x[1]):
+            if name == "job":
+                lane = next((i for i, free in enumerate(lanes) if free <= begin), len(lanes))
+                if lane == len(lanes):
+                    lanes.append(0)
+                lanes[lane] = end
+                tid = "job slot %d" % lane
+                name = args.get("job", name)
+            events.append({"name": name, "ph": "X", "pid": pid, "tid": tid,
+                           "ts": (begin - Timings.start) * 1e6,
+                           "dur": (end - begin) * 1e6,
+                           "args": args})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+    trace_events = staticmethod(trace_events)
+
+    def report(profile = None, summary = False):
+        """Writes the trace event file and/or prints the summary"""
+        if profile:
+            import json
+            with open(profile, "w") as fd:
+                json.dump(Timings.trace_events(), fd)
+        if summary:
+            Timings.summary()
+    report = staticmethod(report)
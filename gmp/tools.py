@@ -1,61 +1,84 @@
 from gmp.options import *
-import subprocess
-import tempfile
+from gmp.scheduler import *
+from gmp.session import *
+import shlex
+import stat
+import sys
 import os
 
-class ScreenExecutor:
-    instance = None
-    def __init__(self):
-        self.screen_fd, self.screen_path = tempfile.mkstemp()
-        self.counter = 0
-        self.screen_fd = os.fdopen(self.screen_fd, "w")
-
-    def get():
-        if not ScreenExecutor.instance:
-            ScreenExecutor.instance = ScreenExecutor()
-        return ScreenExecutor.instance
-    get = staticmethod(get)
-
-    def push(cmd):
-        i = ScreenExecutor.get()
-        i.screen_fd.write("""screen %d sh -c "echo; echo '%s' ; %s; echo Press ENTER;read a"\n"""
-                          % (i.counter, cmd.replace("'", "\\\""), cmd))
-        i.counter += 1
-    push = staticmethod(push)
-
-    def execute():
-        if Options.opt('screen'):
-            i = ScreenExecutor.get()
-            i.screen_fd.write('caption always "%{wR}%c | %?%-Lw%?%{wB}%n*%f %t%?(%u)%?%{wR}%?%+Lw%?"\n')
-            i.screen_fd.close()
-            a = subprocess.Popen("screen -c %s" % i.screen_path, shell=True)
-            a.wait()
-
-            os.unlink(i.screen_path)
-    execute = staticmethod(execute)
-
-
 def esc(str):
-    str = str.replace("\\", "\\\\")
-    quote = False
-    for c in " ;&|{}()$":
-        if c in str:
-            quote = True
-    if quote:
-        return "'" + str.replace("'", "\\'") + "'"
-    return str
+    """Quote str for the shell, if neccessary"""
+    return shlex.quote(str)
+
+def mtime(path):
+    """The modification time of path or None, if it doesn't exist"""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
 
 echo_exec = True
-def execute(cmd, echo=True):
-    if Options.opt('screen'):
-        ScreenExecutor.push(cmd)
-        return
-
-    if echo:
-        print(cmd)
-    a = subprocess.Popen(cmd, shell=(type(cmd) == str))
-
-    # Just wait here if we are not in parallel mode
-    if not Options.opt('parallel'):
-        a.wait()
-    return a
+def execute(cmd, echo=True, remote=None, cwd=None):
+    """Executes cmd (within cwd) with the scheduler. In parallel mode the
+    returned job is started, as soon as there is a free slot. Otherwise
+    it has already finished. In session mode (see Session) the job runs
+    in a window, as soon as there is a free slot. remote is the clone
+    url, if the command talks to the remote site of a repository"""
+    parallel = Options.opt('parallel')
+    session = Session.get()
+    if session:
+        job = SessionJob(cmd, session, echo = echo, cwd = cwd)
+        parallel = True
+    else:
+        job = Job(cmd, echo = echo, capture = parallel, cwd = cwd)
+    if remote:
+        job.remote(remote)
+    Scheduler.get().submit(job)
+
+    if not parallel:
+        job.wait()
+    return job
+
+
+# Number of threads walking a directory tree in chmod_tree
+chmod_workers = 8
+
+def chmod_tree(path, change):
+    """Changes the permissions of path and everything below it (like
+    chmod -R) in-process. change(mode, is_dir) returns the new mode;
+    only entries whose mode actually changes are touched. Directories
+    are walked in parallel. Symlinks are ignored"""
+    import concurrent.futures
+    def apply(path, mode, is_dir):
+        new = change(stat.S_IMODE(mode), is_dir)
+        if new != stat.S_IMODE(mode):
+            os.chmod(path, new)
+
+    def walk(directory):
+        subdirs = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_symlink():
+                        continue
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks = False)
+                        apply(entry.path, entry.stat(follow_symlinks = False).st_mode, is_dir)
+                    except OSError as e:
+                        sys.stderr.write("chmod: %s: %s\n" % (entry.path, e.strerror))
+                        continue
+                    if is_dir:
+                        subdirs.append(entry.path)
+        except OSError as e:
+            sys.stderr.write("chmod: %s: %s\n" % (directory, e.strerror))
+        return subdirs
+
+    apply(path, os.lstat(path).st_mode, True)
+    with concurrent.futures.ThreadPoolExecutor(chmod_workers) as pool:
+        pending = {pool.submit(walk, path)}
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when = concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                for directory in future.result():
+                    pending.add(pool.submit(walk, directory))
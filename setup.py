@@ -22,6 +22,7 @@ some of the listed repos and execute various scm commands on the in a single ste
 	license = "GPLv3",
     url='http://github.com/stettberger/metagit/',
     packages=['gmp'],
+    python_requires='>=3.10',
     cmdclass = {'build_manpage': build_manpage},
     scripts=['bin/metagit'],
     zip_safe=False,
@@ -0,0 +1,132 @@
+"""The HTTP client and the paginated API listings against a local
+stand-in for the Github and Gitlab APIs:
+
+  python3 -m unittest discover tests
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import http.server
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from gmp.main import *
+from gmp.httpclient import HTTPClient
+
+
+class API(http.server.BaseHTTPRequestHandler):
+    """Serves three pages of two repositories each. Github pages carry a
+    Link header, Gitlab pages X-Total-Pages. Every page has an ETag"""
+    protocol_version = "HTTP/1.1"
+    pages = 3
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        API.requests.append((self.path, dict(self.headers)))
+        path, _, query = self.path.partition("?")
+        if path == "/users/old/repos":
+            return self.reply(301, b"", {"Location": "/users/me/repos?" + query})
+        params = dict(x.split("=") for x in query.split("&") if x)
+        page = int(params.get("page", 1))
+        etag = '"%s-%d"' % (path, page)
+        if self.headers.get("If-None-Match") == etag:
+            return self.reply(304, b"", {"ETag": etag})
+
+        names = ["r%d" % n for n in range(2 * page - 1, 2 * page + 1)]
+        headers = {"ETag": etag}
+        if path == "/users/me/repos":
+            body = [{"name": x, "has_wiki": False, "pushed_at": "2020-01-01T00:00:00Z"}
+                    for x in names]
+            headers["Link"] = '<http://%s%s?per_page=100&page=%d>; rel="last"' \
+                % (self.headers["Host"], path, self.pages)
+        elif path == "/gitlab/projects":
+            body = [{"name": x, "path_with_namespace": "me/" + x,
+                     "ssh_url_to_repo": "git@gitlab:me/%s.git" % x} for x in names]
+            headers["X-Total-Pages"] = str(self.pages)
+        else:
+            return self.reply(404, b"", {})
+        self.reply(200, json.dumps(body).encode(), headers)
+
+    def reply(self, status, body, headers):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class HTTPListingTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), API)
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.directory = tempfile.mkdtemp(prefix = "metagit-test-")
+        API.requests = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+        del RepoLister.listers[:]
+
+    def github(self, username = "me"):
+        lister = Github(username, protocol = "https", into = self.directory,
+                        cache = os.path.join(self.directory, "cache"))
+        lister.api = self.url
+        return lister
+
+    def test_user_agent(self):
+        status, headers, body = HTTPClient.get().request(self.url + "/users/me/repos")
+        self.assertEqual(status, 200)
+        self.assertEqual(API.requests[0][1].get("User-Agent"), "metagit")
+
+    def test_github_link_pagination(self):
+        lister = self.github()
+        lister.get_list()
+        self.assertEqual(sorted(lister.clone_urls),
+                         sorted(["https://me@github.com/me/r%d.git" % n for n in range(1, 7)]))
+        self.assertEqual(len(API.requests), 3)
+        self.assertEqual(len(lister.pushed_at), 6)
+
+    def test_github_redirect(self):
+        lister = self.github("old")
+        lister.get_list()
+        self.assertEqual(len(lister.clone_urls), 6)
+
+    def test_gitlab_total_pages(self):
+        lister = RepoLister(name = "gitlab")
+        pages = lister.http_get_pages(self.url + "/gitlab/projects?per_page=100", Gitlab.pages)
+        names = [repo["name"] for page in pages for repo in json.loads(page)]
+        self.assertEqual(names, ["r%d" % n for n in range(1, 7)])
+
+    def test_not_modified(self):
+        lister = self.github()
+        lister.get_list()
+        # As if the validators were loaded from the cache
+        lister.validators = lister.new_validators
+        lister.new_validators = {}
+        API.requests = []
+        lister.get_list()
+        self.assertTrue(lister.not_modified)
+        self.assertEqual(lister.clone_urls, [])
+        self.assertTrue(all(headers.get("If-None-Match") for path, headers in API.requests))
+
+    def test_not_modified_keeps_cache(self):
+        lister = self.github()
+        repos = lister.refresh()
+        lister.validators = lister.new_validators
+        self.assertEqual(len(lister.refresh(cached = repos)), 6)
+        self.assertTrue(lister.not_modified)
+
+
+if __name__ == "__main__":
+    unittest.main()